@@ -0,0 +1,189 @@
+# bench/fake_api.py — локальная замена Telegram Bot API для нагрузочных прогонов
+# - отвечает на методы, которые вызывает бот, правдоподобными объектами
+# - пишет журнал вызовов (метод, чат, время) и считает их по методам
+# - добавляет задержку ответа и с заданной вероятностью отвечает 429 (RetryAfter)
+#
+# Отдельно:  python -m bench.fake_api --port 8081 --latency 0.05 --retry-rate 0.01
+# и бот с BOT_API_URL=http://127.0.0.1:8081 (в т.ч. с WORKERS>1).
+
+import argparse, asyncio, itertools, json, logging, random, signal, threading, time
+from collections import Counter
+from typing import Callable, Dict, List, Optional, Tuple
+
+import tornado.web
+
+log = logging.getLogger("bench.fake_api")
+
+# (метод, chat_id, время monotonic)
+Call = Tuple[str, Optional[int], float]
+
+
+class FakeBotAPI:
+    """Фейковый Bot API. on_call(method, params, result) — хук для генератора нагрузки;
+    вызывается в потоке сервера."""
+
+    def __init__(self, port: int = 8081, latency: float = 0.0, jitter: float = 0.0,
+                 retry_rate: float = 0.0, retry_after: int = 1,
+                 on_call: Optional[Callable[[str, dict, dict], None]] = None):
+        self.port = port
+        self.latency = latency
+        self.jitter = jitter
+        self.retry_rate = retry_rate
+        self.retry_after = retry_after
+        self.on_call = on_call
+        self.calls: List[Call] = []
+        self.counts: Counter = Counter()
+        self.retries = 0
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+        self._ready = threading.Event()
+        self._stop_event: Optional[asyncio.Event] = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    # ---------- ответы ----------
+    def _message(self, chat_id, **extra) -> dict:
+        return {
+            "message_id": next(self._ids),
+            "date": int(time.time()),
+            "chat": {"id": int(chat_id or 0), "type": "private"},
+            **extra,
+        }
+
+    def _result(self, method: str, p: dict):
+        chat_id = p.get("chat_id")
+        if method == "getMe":
+            return {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+        if method in ("setWebhook", "deleteWebhook", "answerCallbackQuery"):
+            return True
+        if method == "getWebhookInfo":
+            return {"url": "", "has_custom_certificate": False, "pending_update_count": 0}
+        if method == "sendPoll":
+            options = p.get("options") or []
+            return self._message(chat_id, poll={
+                "id": str(next(self._ids)),
+                "question": p.get("question", ""),
+                "options": [{"text": o if isinstance(o, str) else o.get("text", ""), "voter_count": 0}
+                            for o in options],
+                "total_voter_count": 0,
+                "is_closed": False,
+                "is_anonymous": bool(p.get("is_anonymous", True)),
+                "type": "regular",
+                "allows_multiple_answers": bool(p.get("allows_multiple_answers", False)),
+            })
+        if method == "sendAnimation":
+            fid = f"anim-{next(self._ids)}"
+            return self._message(chat_id, animation={
+                "file_id": fid, "file_unique_id": fid, "width": 1, "height": 1, "duration": 1,
+            })
+        if method == "sendDocument":
+            fid = f"doc-{next(self._ids)}"
+            return self._message(chat_id, document={"file_id": fid, "file_unique_id": fid})
+        if method == "editMessageText":
+            return self._message(chat_id, text=p.get("text", ""))
+        return self._message(chat_id, text=p.get("text", ""))
+
+    def _record(self, method: str, p: dict):
+        chat_id = p.get("chat_id")
+        with self._lock:
+            self.calls.append((method, int(chat_id) if chat_id is not None else None, time.monotonic()))
+            self.counts[method] += 1
+
+    def stats(self) -> Dict[str, int]:
+        with self._lock:
+            return dict(self.counts)
+
+    # ---------- сервер ----------
+    def _app(self) -> tornado.web.Application:
+        api = self
+
+        class Handler(tornado.web.RequestHandler):
+            async def post(self, token: str, method: str):
+                p = {}
+                for name, values in self.request.body_arguments.items():
+                    raw = values[-1].decode("utf-8")
+                    try:
+                        p[name] = json.loads(raw)
+                    except ValueError:
+                        p[name] = raw
+                if self.request.headers.get("Content-Type", "").startswith("application/json") and self.request.body:
+                    p.update(json.loads(self.request.body))
+                delay = api.latency + random.uniform(0, api.jitter)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                if method.startswith("send") and random.random() < api.retry_rate:
+                    api.retries += 1
+                    self.set_status(429)
+                    self.write({
+                        "ok": False, "error_code": 429,
+                        "description": f"Too Many Requests: retry after {api.retry_after}",
+                        "parameters": {"retry_after": api.retry_after},
+                    })
+                    return
+                api._record(method, p)
+                result = api._result(method, p)
+                if api.on_call is not None:
+                    api.on_call(method, p, result)
+                self.write({"ok": True, "result": result})
+
+            get = post
+
+        return tornado.web.Application([(r"/bot([^/]+)/(\w+)", Handler)])
+
+    async def serve(self, stop: Optional[asyncio.Event] = None):
+        server = self._app().listen(self.port, "127.0.0.1")
+        self._loop = asyncio.get_running_loop()
+        self._ready.set()
+        try:
+            await (stop or asyncio.Event()).wait()
+        finally:
+            server.stop()
+
+    def start_in_thread(self):
+        """Сервер в своём потоке со своим loop — не делит event loop с ботом."""
+        def run():
+            async def main():
+                self._stop_event = asyncio.Event()
+                await self.serve(self._stop_event)
+            asyncio.run(main())
+
+        self._thread = threading.Thread(target=run, name="fake-bot-api", daemon=True)
+        self._thread.start()
+        self._ready.wait(5)
+
+    def stop(self):
+        if self._thread is not None and self._loop is not None:
+            self._loop.call_soon_threadsafe(self._stop_event.set)
+            self._thread.join(5)
+            self._thread = None
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Fake Telegram Bot API")
+    ap.add_argument("--port", type=int, default=8081)
+    ap.add_argument("--latency", type=float, default=0.0, help="задержка ответа, сек")
+    ap.add_argument("--jitter", type=float, default=0.0, help="случайная добавка к задержке, сек")
+    ap.add_argument("--retry-rate", type=float, default=0.0, help="доля send* с ответом 429")
+    ap.add_argument("--retry-after", type=int, default=1)
+    args = ap.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    api = FakeBotAPI(args.port, args.latency, args.jitter, args.retry_rate, args.retry_after)
+    log.info("Fake Bot API on %s", api.url)
+
+    async def serve():
+        stop = asyncio.Event()
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, stop.set)
+        await api.serve(stop)
+
+    asyncio.run(serve())
+    log.info("Calls: %s, 429 sent: %d", api.stats(), api.retries)
+
+
+if __name__ == "__main__":
+    main()
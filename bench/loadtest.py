@@ -0,0 +1,252 @@
+# bench/loadtest.py — нагрузочный прогон бота целиком, без сети
+# - поднимает фейковый Bot API (bench/fake_api.py) и бота в одном процессе,
+#   БД и questions.json — во временной папке
+# - N пользователей регистрируются, админ жмёт «Старт», каждый отвечает на опросы
+#   со случайной паузой «на подумать»
+# - в конце: p50/p99 ответ → следующий опрос, пропускная способность записи в БД,
+#   число исходящих вызовов по методам, время сборки отчёта
+#
+#   python -m bench.loadtest --users 1000 --questions 10 --think 0.2 2 --rate 1000
+#   python -m bench.loadtest --users 300 --latency 0.05 --jitter 0.05 --retry-rate 0.01 --json out.json
+
+import argparse, asyncio, importlib, itertools, json, logging, os, random, shutil, sys, tempfile, time
+from typing import Dict, List, Set
+
+from bench.fake_api import FakeBotAPI
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+ADMIN_ID = 1
+FIRST_USER = 1_000_000
+
+
+def percentile(values: List[float], p: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100 * (len(values) - 1))))]
+
+
+def make_questions(n: int, options: int = 4) -> list:
+    out = []
+    for i in range(n):
+        multiple = i % 3 == 2
+        out.append({
+            "text": f"Вопрос нагрузочного теста №{i + 1}",
+            "options": [f"Вариант {k + 1}" for k in range(options)],
+            "correct_indices": [0, 1] if multiple else [i % options],
+            "multiple": multiple,
+        })
+    return out
+
+
+class Simulation:
+    """Виртуальные участники: отвечают на каждый пришедший им опрос через think секунд.
+    Вопросы и порядок вариантов — по билету участника (paper_for), как их видит бот."""
+
+    def __init__(self, main, app, users: List[int], think: tuple, accuracy: float):
+        self.main = main
+        self.app = app
+        self.users = set(users)
+        self.papers: Dict[int, object] = {}
+        self.think = think
+        self.accuracy = accuracy
+        self.loop = asyncio.get_running_loop()
+        self._update_ids = itertools.count(1)
+        self.answers: Dict[int, int] = {}
+        self.answered_at: Dict[int, float] = {}
+        self.finishing: Set[int] = set()
+        self.done: Set[int] = set()
+        self.next_poll_latency: List[float] = []
+        self.final_latency: List[float] = []
+
+    # ---------- входящие апдейты ----------
+    def _user(self, uid: int) -> dict:
+        return {"id": uid, "is_bot": False, "first_name": f"u{uid}"}
+
+    def feed(self, data: dict):
+        data["update_id"] = next(self._update_ids)
+        self.app.update_queue.put_nowait(self.main.Update.de_json(data, self.app.bot))
+
+    def callback(self, uid: int, payload: str):
+        self.feed({"callback_query": {
+            "id": str(next(self._update_ids)),
+            "from": self._user(uid),
+            "chat_instance": str(uid),
+            "data": payload,
+            "message": {"message_id": 1, "date": int(time.time()), "chat": {"id": uid, "type": "private"}},
+        }})
+
+    def paper(self, uid: int):
+        paper = self.papers.get(uid)
+        if paper is None:   # попытка уже начата: банк — её версия
+            paper = self.papers[uid] = self.main.paper_for(self.main.st(uid).bank, uid)
+        return paper
+
+    def answer(self, uid: int, poll_id: str, pos: int):
+        paper = self.paper(uid)
+        q, perm = paper.question(pos), paper.perm(pos)
+        if random.random() < self.accuracy:
+            chosen = list(q.correct) if perm is None else [perm.index(i) for i in q.correct]
+        else:
+            chosen = [random.randrange(len(q.options))]
+        self.answers[uid] = self.answers.get(uid, 0) + 1
+        if self.answers[uid] >= len(paper):
+            self.finishing.add(uid)
+        self.answered_at[uid] = time.monotonic()
+        self.feed({"poll_answer": {"poll_id": poll_id, "user": self._user(uid), "option_ids": chosen}})
+
+    # ---------- исходящие вызовы (из потока фейкового API) ----------
+    def on_call(self, method: str, params: dict, result):
+        chat_id = params.get("chat_id")
+        if chat_id is None or int(chat_id) not in self.users:
+            return
+        self.loop.call_soon_threadsafe(self._on_call, method, int(chat_id), result, time.monotonic())
+
+    def _on_call(self, method: str, uid: int, result, at: float):
+        if method == "sendPoll":
+            t0 = self.answered_at.pop(uid, None)
+            if t0 is not None:
+                self.next_poll_latency.append(at - t0)
+            pos = self.answers.get(uid, 0)
+            self.loop.call_later(random.uniform(*self.think), self.answer, uid, result["poll"]["id"], pos)
+        elif method == "sendMessage" and uid in self.finishing and uid not in self.done:
+            t0 = self.answered_at.pop(uid, None)
+            if t0 is not None:
+                self.final_latency.append(at - t0)
+            self.done.add(uid)
+
+
+def _setup_env(args, api_url: str):
+    os.environ.update({
+        "BOT_TOKEN": "0:bench",
+        "PUBLIC_URL": "http://127.0.0.1",
+        "ADMINS": str(ADMIN_ID),
+        "BOT_API_URL": api_url,
+        "BROADCAST_RATE": str(args.rate),
+        "BROADCAST_BURST": str(max(1, int(args.rate))),
+        "PER_CHAT_INTERVAL": str(args.per_chat_interval),
+        "COMBINE_MESSAGES": "0" if args.no_combine else "1",
+    })
+
+
+async def run(args) -> dict:
+    api = FakeBotAPI(args.port, args.latency, args.jitter, args.retry_rate)
+    api.start_in_thread()
+    _setup_env(args, api.url)
+    sys.path.insert(0, ROOT)
+    main = importlib.import_module("main")
+
+    questions = make_questions(args.questions)
+    with open(main.QUESTIONS_FILE, "w", encoding="utf-8") as f:
+        json.dump(questions, f, ensure_ascii=False)
+
+    app = main.build_app()
+    result: dict = {"users": args.users, "questions": args.questions}
+    try:
+        # тот же жизненный цикл, что в проде: отмена фоновых задач, остановка, сброс записи
+        async with main.running(app):
+            users = list(range(FIRST_USER, FIRST_USER + args.users))
+            sim = Simulation(main, app, users, tuple(args.think), args.accuracy)
+            api.on_call = sim.on_call
+            for uid in users:
+                sim.callback(uid, f"set_country:{random.choice(main.COUNTRIES)}")
+            while app.update_queue.qsize():
+                await asyncio.sleep(0.05)
+            await main.WRITER.flush()
+
+            written0, t0 = main.WRITER.written, time.monotonic()
+            sim.callback(ADMIN_ID, "admin:start")
+            deadline = t0 + args.timeout
+            while len(sim.done) < len(users) and time.monotonic() < deadline:
+                await asyncio.sleep(0.2)
+            await main.WRITER.flush()
+            wall = time.monotonic() - t0
+            ops = main.WRITER.written - written0
+
+            rt0 = time.monotonic()
+            path = await main.export_results_file()
+            report_s = time.monotonic() - rt0
+
+            result.update({
+                "finished": len(sim.done),
+                "wall_s": round(wall, 3),
+                "next_poll_ms": {
+                    "n": len(sim.next_poll_latency),
+                    "p50": round(percentile(sim.next_poll_latency, 50) * 1000, 1),
+                    "p99": round(percentile(sim.next_poll_latency, 99) * 1000, 1),
+                    "max": round(max(sim.next_poll_latency, default=0) * 1000, 1),
+                },
+                "final_ms": {
+                    "n": len(sim.final_latency),
+                    "p50": round(percentile(sim.final_latency, 50) * 1000, 1),
+                    "p99": round(percentile(sim.final_latency, 99) * 1000, 1),
+                },
+                "db_ops": ops,
+                "db_ops_per_s": round(ops / wall, 1) if wall else 0.0,
+                "calls": api.stats(),
+                "retry_after_sent": api.retries,
+                "report_s": round(report_s, 3),
+                "report_bytes": os.path.getsize(path),
+            })
+    finally:
+        api.stop()
+    return result
+
+
+def print_result(r: dict):
+    print(f"users={r['users']} questions={r['questions']} finished={r.get('finished', 0)} "
+          f"wall={r.get('wall_s', 0)}s")
+    if "next_poll_ms" not in r:
+        return
+    n, f = r["next_poll_ms"], r["final_ms"]
+    print(f"answer → next poll: n={n['n']} p50={n['p50']}ms p99={n['p99']}ms max={n['max']}ms")
+    print(f"answer → final:     n={f['n']} p50={f['p50']}ms p99={f['p99']}ms")
+    print(f"DB writes: {r['db_ops']} ops, {r['db_ops_per_s']} ops/s")
+    print("Bot API calls: " + ", ".join(f"{m}={c}" for m, c in sorted(r["calls"].items()))
+          + f"; 429 injected: {r['retry_after_sent']}")
+    print(f"Report: {r['report_s']}s, {r['report_bytes']} bytes")
+
+
+def main():
+    ap = argparse.ArgumentParser(description="Quiz bot load test against a fake Bot API")
+    ap.add_argument("--users", type=int, default=200)
+    ap.add_argument("--questions", type=int, default=10)
+    ap.add_argument("--think", type=float, nargs=2, default=(0.5, 3.0), metavar=("MIN", "MAX"),
+                    help="пауза перед ответом, сек (меньше времени на вопрос)")
+    ap.add_argument("--accuracy", type=float, default=0.7, help="доля правильных ответов")
+    ap.add_argument("--rate", type=float, default=25, help="BROADCAST_RATE бота, сообщений/сек")
+    ap.add_argument("--per-chat-interval", type=float, default=1.0)
+    ap.add_argument("--no-combine", action="store_true", help="COMBINE_MESSAGES=0")
+    ap.add_argument("--latency", type=float, default=0.0, help="задержка фейкового API, сек")
+    ap.add_argument("--jitter", type=float, default=0.0)
+    ap.add_argument("--retry-rate", type=float, default=0.0, help="доля send* с ответом 429")
+    ap.add_argument("--port", type=int, default=8081)
+    ap.add_argument("--timeout", type=float, default=600, help="предел длительности раунда, сек")
+    ap.add_argument("--json", help="сохранить результат в файл (для сравнения прогонов)")
+    ap.add_argument("--keep", action="store_true", help="не удалять рабочую папку (БД, отчёт)")
+    ap.add_argument("-v", "--verbose", action="store_true")
+    args = ap.parse_args()
+
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+    json_path = os.path.abspath(args.json) if args.json else None
+    workdir = tempfile.mkdtemp(prefix="quizbench-")
+    cwd = os.getcwd()
+    os.chdir(workdir)
+    try:
+        result = asyncio.run(run(args))
+    finally:
+        os.chdir(cwd)
+        if args.keep:
+            print(f"Workdir: {workdir}")
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+    if not args.verbose:
+        logging.disable(logging.CRITICAL)
+    print_result(result)
+    if json_path:
+        with open(json_path, "w", encoding="utf-8") as f:
+            json.dump(result, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == "__main__":
+    main()
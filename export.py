@@ -0,0 +1,145 @@
+# export.py — потоковая выгрузка ответов раунда (gzip CSV / JSONL)
+# - строки идут из курсора SQLite пачками прямо в gzip: память не зависит от размера раунда
+# - выгрузка режется на части не больше part_bytes (сжатых), каждая — самостоятельный .gz,
+#   который можно загрузить отдельно (лимит документа у Bot API — 50 МБ)
+# - чистка каталога выгрузок: файлы старше заданного возраста удаляются
+
+import csv, gzip, io, itertools, json, os, time
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from storage import ExportRow, mask_options
+
+FORMATS = ("csv", "jsonl")
+COLUMNS = ("seq", "round", "country", "user_id", "question", "options", "correct", "bank")
+COMPRESS_LEVEL = 6   # как у zlib по умолчанию: заметно быстрее 9 при почти том же размере
+BATCH = 1000         # строк за одну запись в gzip; между пачками проверяется размер части
+
+
+class _Formatter:
+    """Строки выгрузки пачкой. Маски и страны повторяются — их текст считается один раз."""
+
+    def __init__(self):
+        self.options: Dict[int, Tuple[str, str]] = {}   # маска -> (CSV, JSON)
+        self.countries: Dict[str, str] = {}              # страна -> JSON-строка
+
+    def _options(self, mask: int) -> Tuple[str, str]:
+        out = self.options.get(mask)
+        if out is None:
+            options = mask_options(mask)
+            out = self.options[mask] = (" ".join(map(str, options)), json.dumps(options))
+        return out
+
+    def csv_rows(self, rows: List[ExportRow]) -> list:
+        return [(seq, rnd, country, uid, qidx + 1, self._options(mask)[0], correct, bank)
+                for seq, rnd, country, uid, qidx, mask, correct, bank in rows]
+
+    def jsonl(self, rows: List[ExportRow]) -> str:
+        out = []
+        for seq, rnd, country, uid, qidx, mask, correct, bank in rows:
+            name = self.countries.get(country)
+            if name is None:
+                name = self.countries[country] = json.dumps(country, ensure_ascii=False)
+            out.append(f'{{"seq": {seq}, "round": {rnd}, "country": {name}, "user_id": {uid}, '
+                       f'"question": {qidx + 1}, "options": {self._options(mask)[1]}, '
+                       f'"correct": {"true" if correct else "false"}, "bank": {bank}}}\n')
+        return "".join(out)
+
+
+class _Part:
+    """Одна часть выгрузки: текст → gzip → файл."""
+
+    def __init__(self, path: str, fmt: str, formatter: _Formatter):
+        self.path = path
+        self.formatter = formatter
+        self.raw = open(path, "wb")
+        # без имени внутри gzip: часть может быть переименована, gunzip берёт имя файла
+        self.gz = gzip.GzipFile(filename="", mode="wb", fileobj=self.raw, compresslevel=COMPRESS_LEVEL)
+        self.text = io.TextIOWrapper(self.gz, encoding="utf-8", newline="")
+        self.csv = None
+        if fmt == "csv":
+            self.csv = csv.writer(self.text)
+            self.csv.writerow(COLUMNS)
+
+    def write(self, rows: List[ExportRow]):
+        if self.csv is not None:
+            self.csv.writerows(self.formatter.csv_rows(rows))
+        else:
+            self.text.write(self.formatter.jsonl(rows))
+
+    def size(self) -> int:
+        """Сжатый размер на диске (без хвоста в буферах zlib — отсюда запас в part_bytes)."""
+        return self.raw.tell()
+
+    def close(self):
+        self.text.close()   # закрывает и gzip; файл закрываем сами (fileobj)
+        self.raw.close()
+
+
+def write_export(rows: Iterable[ExportRow], directory: str, stem: str, fmt: str = "csv",
+                 part_bytes: int = 45 * 1024 * 1024) -> Tuple[List[str], int, int]:
+    """Пишет строки в directory/stem[_partN].fmt.gz. Возвращает (пути частей, число строк,
+    максимальный seq). Пустая выгрузка — ([], 0, 0), файлов не остаётся."""
+    if fmt not in FORMATS:
+        raise ValueError(f"unknown export format {fmt!r}")
+    os.makedirs(directory, exist_ok=True)
+    paths: List[str] = []
+    part: Optional[_Part] = None
+    formatter = _Formatter()
+    count = last_seq = 0
+    rows = iter(rows)
+    try:
+        while True:
+            batch = list(itertools.islice(rows, BATCH))
+            if not batch:
+                break
+            if part is None:
+                paths.append(os.path.join(directory, f"{stem}_part{len(paths) + 1}.{fmt}.gz"))
+                part = _Part(paths[-1], fmt, formatter)
+            part.write(batch)
+            count += len(batch)
+            last_seq = max(last_seq, max(row[0] for row in batch))
+            if part.size() >= part_bytes:
+                part.close()
+                part = None
+    except BaseException:
+        if part is not None:
+            part.close()
+        for path in paths:
+            _unlink(path)
+        raise
+    if part is not None:
+        part.close()
+    if len(paths) == 1:   # одна часть — без суффикса _part1
+        single = os.path.join(directory, f"{stem}.{fmt}.gz")
+        os.replace(paths[0], single)
+        paths = [single]
+    return paths, count, last_seq
+
+
+def cleanup(directory: str, max_age: float, prefixes: Tuple[str, ...], suffix: str = "",
+            now: Optional[float] = None) -> int:
+    """Удаляет файлы выгрузок (имя начинается с одного из prefixes и кончается suffix)
+    старше max_age секунд."""
+    now = time.time() if now is None else now
+    removed = 0
+    try:
+        entries = list(os.scandir(directory))
+    except FileNotFoundError:
+        return 0
+    for entry in entries:
+        if not entry.is_file() or not entry.name.startswith(prefixes) or not entry.name.endswith(suffix):
+            continue
+        try:
+            if now - entry.stat().st_mtime > max_age:
+                os.unlink(entry.path)
+                removed += 1
+        except FileNotFoundError:   # удалил соседний шард
+            pass
+    return removed
+
+
+def _unlink(path: str):
+    try:
+        os.unlink(path)
+    except FileNotFoundError:
+        pass
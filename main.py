@@ -5,32 +5,79 @@
 # - Мгновенная обратная связь участнику (верно/неверно + правильные)
 # - Финальное личное резюме + "салют" (GIF/текст)
 # - Excel-отчёт для админа
-# - Полный сброс данных (админ-кнопка "🗑 Сбросить всё" с подтверждением)
+# - Сброс = новый раунд (админ-кнопка "🗑 Сбросить всё" с подтверждением), отчёты по раундам
 # - Админ-панель с кнопками управления (/admin)
-
-import os, json, sqlite3, asyncio, time, logging
-from dataclasses import dataclass
-from typing import List, Optional, Dict, Set, Tuple
+# - Групповой режим: привязанная группа, один общий опрос на вопрос (/bind, /group_start)
+# - Большие банки: вопросы в SQLite по теме/сложности, личный билет (выборка + перемешивание вариантов) из seed
+# - Потоковая выгрузка ответов (gzip CSV/JSONL частями, режим «только новое»), чистка старых выгрузок
+
+import os, re, json, asyncio, time, logging, hashlib, heapq, itertools, signal, threading, functools, random
+BOOT_T0 = time.perf_counter()   # начало холодного старта (до тяжёлых импортов)
+import multiprocessing
+from contextlib import asynccontextmanager
+from collections import deque
+from pathlib import Path
+from dataclasses import dataclass, replace
+from typing import List, Optional, Dict, Tuple, Set, Deque, Callable, Awaitable
 
 import httpx
-import openpyxl
-from openpyxl.utils import get_column_letter
+import tornado.web
+# openpyxl (отчёт) и profiling импортируются при первом использовании — холодный старт без них
 
 from telegram import Update, InlineKeyboardMarkup, InlineKeyboardButton
+from telegram.error import RetryAfter, NetworkError, BadRequest
 from telegram.ext import (
-    ApplicationBuilder, Application, ContextTypes,
+    ApplicationBuilder, Application, BaseUpdateProcessor, ContextTypes,
     CommandHandler, CallbackQueryHandler, PollAnswerHandler
 )
+from telegram.request import HTTPXRequest
+
+import export, metrics
+from storage import (
+    Storage, WriteBehind, BankQuestionRow, options_mask, mask_options, set_query_observer
+)
 
 # ---------- ЛОГИ ----------
 logging.basicConfig(level=logging.INFO)
 log = logging.getLogger("quizbot")
 
+# ---------- ХОЛОДНЫЙ СТАРТ ----------
+class StartupTimer:
+    """Разбивка старта по фазам для лога: mark(имя) закрывает фазу, начатую предыдущей
+    отметкой. first_update() — время от старта процесса до первого обработанного апдейта."""
+
+    def __init__(self, t0: float):
+        self.t0 = self.last = t0
+        self.phases: List[Tuple[str, float]] = []
+        self.served = False
+
+    def mark(self, name: str):
+        now = time.perf_counter()
+        self.phases.append((name, now - self.last))
+        self.last = now
+
+    @property
+    def total(self) -> float:
+        return self.last - self.t0
+
+    def report(self):
+        parts = ", ".join(f"{name} {sec * 1000:.0f}ms" for name, sec in self.phases)
+        log.info("Startup %.0fms: %s", self.total * 1000, parts)
+
+    def first_update(self):
+        self.served = True
+        log.info("First update handled %.0fms after start", (time.perf_counter() - self.t0) * 1000)
+
+STARTUP = StartupTimer(BOOT_T0)
+STARTUP.mark("imports")
+
 # ---------- ОКРУЖЕНИЕ ----------
 BOT_TOKEN   = (os.getenv("BOT_TOKEN")   or "").strip()
 PUBLIC_URL  = (os.getenv("PUBLIC_URL")  or "").strip().rstrip("/")
 PORT        = int(os.getenv("PORT", "10000"))
 ADMINS_ENV  = os.getenv("ADMINS", "")
+# Другой сервер Bot API (локальный telegram-bot-api или фейковый из bench/)
+BOT_API_URL = (os.getenv("BOT_API_URL") or "https://api.telegram.org").strip().rstrip("/")
 
 # Салют/поздравление после прохождения
 CELEBRATE = (os.getenv("CELEBRATE", "1").strip() == "1")
@@ -51,55 +98,366 @@ if not PUBLIC_URL:
 ADMIN_IDS = {int(x) for x in ADMINS_ENV.split(",") if x.strip().isdigit()} or {133637780}
 
 DB_FILE        = "quiz.db"
+DB_FLUSH_MS    = int(os.getenv("DB_FLUSH_MS", "50"))   # макс. задержка пакетной записи в БД
 QUESTIONS_FILE = "questions.json"
+BANK_CACHE_FILE = "questions.cache"   # скомпилированный банк (JSON); ключ — mtime/размер QUESTIONS_FILE и sha банка
 COUNTRIES      = ["Россия", "Казахстан", "Армения", "Беларусь", "Кыргызстан"]
 QUESTION_SECONDS = 30   # ⏱️ время на вопрос — 30 секунд
 COUNTDOWN         = 3
 
+# Билет участника: выборка из банка и порядок вариантов — детерминированно по (банк, раунд,
+# участник), поэтому билет не хранится, а пересобирается при ответе, сводке и рестарте
+def _parse_paper_mix(raw: str) -> List[Tuple[int, int]]:
+    """«сложность:сколько,…» → [(сложность, сколько)…]; сверка с банком — paper_config_problems."""
+    mix = []
+    for part in (p.strip() for p in raw.split(",")):
+        if not part:
+            continue
+        difficulty, sep, count = part.partition(":")
+        try:
+            if not sep:
+                raise ValueError
+            item = (int(difficulty), int(count))
+        except ValueError:
+            raise RuntimeError(f"PAPER_MIX: {part!r} is not «difficulty:count» (например, 1:3,2:4,3:3).") from None
+        if item[1] <= 0:
+            raise RuntimeError(f"PAPER_MIX: count must be positive in {part!r}.")
+        if item[0] in (d for d, _ in mix):
+            raise RuntimeError(f"PAPER_MIX: difficulty {item[0]} is listed twice.")
+        mix.append(item)
+    return mix
+
+PAPER_SIZE      = int(os.getenv("PAPER_SIZE", "0"))   # вопросов в билете; 0 — весь банк по порядку
+PAPER_MIX       = _parse_paper_mix(os.getenv("PAPER_MIX", ""))   # «сложность:сколько,…», напр. 1:3,2:4,3:3
+PAPER_TOPICS    = {t.strip() for t in os.getenv("PAPER_TOPICS", "").split(",") if t.strip()}
+SHUFFLE_OPTIONS = (os.getenv("SHUFFLE_OPTIONS", "0").strip() == "1")
+QUESTION_CACHE_SIZE = int(os.getenv("QUESTION_CACHE_SIZE", "2048"))   # скомпилированных вопросов в памяти
+PAPER_CACHE_SIZE    = 4096
+
+# Лимиты исходящих сообщений (Telegram: ~30 сообщений/сек на бота, ~1/сек в один чат)
+BROADCAST_RATE     = float(os.getenv("BROADCAST_RATE", "25"))
+BROADCAST_BURST    = int(os.getenv("BROADCAST_BURST", "25"))
+PER_CHAT_INTERVAL  = float(os.getenv("PER_CHAT_INTERVAL", "1.0"))
+PER_CHAT_BURST     = int(os.getenv("PER_CHAT_BURST", "3"))      # короткая пачка в чат (отзыв + вопрос)
+OUTBOX_WORKERS     = int(os.getenv("OUTBOX_WORKERS", "16"))
+COSMETIC_TTL       = float(os.getenv("COSMETIC_TTL", "120"))   # салют старше этого под нагрузкой выбрасываем
+
+# Режим склейки: отзыв — в заголовок следующего опроса, финал+салют+сводка — одним сообщением
+COMBINE_MESSAGES   = (os.getenv("COMBINE_MESSAGES", "1").strip() == "1")
+POLL_QUESTION_LIMIT = 300    # лимит Telegram на текст вопроса опроса
+MESSAGE_LIMIT       = 4096   # лимит Telegram на текст сообщения
+PROGRESS_EVERY     = 2.0   # как часто обновлять прогресс у админа, сек
+
+# Тёплый рестарт: состояние попыток поднимается из журнала, апдейты за время рестарта обрабатываются
+DROP_PENDING_UPDATES = (os.getenv("DROP_PENDING_UPDATES", "0").strip() == "1")
+
+# Несколько процессов: фронт раскладывает апдейты по воркерам по user_id (1 — один процесс, как раньше)
+WORKERS = max(1, int(os.getenv("WORKERS", "1")))
+ALLOWED_UPDATES = ["message", "callback_query", "poll_answer"]
+
+# Раунды: сброс открывает новый раунд. Сырые ответы/регистрации хранятся у последних
+# ROUND_KEEP раундов, у более старых в фоне удаляются (сводки по странам остаются)
+ROUND_KEEP = max(1, int(os.getenv("ROUND_KEEP", "3")))
+ROUND_PURGE_CHUNK = 2000   # пользователей за одну транзакцию чистки
+
+# Выгрузки (Excel-отчёт и gzip CSV/JSONL) пишутся в EXPORT_DIR; файлы старше EXPORT_KEEP_HOURS удаляются
+EXPORT_DIR        = os.getenv("EXPORT_DIR", "exports")
+EXPORT_KEEP_HOURS = float(os.getenv("EXPORT_KEEP_HOURS", "24"))
+EXPORT_PART_MB    = int(os.getenv("EXPORT_PART_MB", "45"))   # сжатая часть; документ в Bot API — до 50 МБ
+EXPORT_CHUNK      = 5000    # строк из курсора за раз
+EXPORT_UPLOAD_TIMEOUT = 300  # загрузка одной части, сек
+
+# Параллельная обработка апдейтов: разные пользователи — одновременно, один пользователь — строго по очереди
+UPDATE_CONCURRENCY = int(os.getenv("UPDATE_CONCURRENCY", "64"))
+UPDATE_BACKLOG     = int(os.getenv("UPDATE_BACKLOG", str(UPDATE_CONCURRENCY * 8)))  # апдейтов «в полёте»
+
+# ---------- МЕТРИКИ ----------
+# GET /metrics на порту вебхука (формат Prometheus). METRICS_TOKEN — если задан,
+# нужен ?token=… или заголовок Authorization: Bearer ….
+METRICS_TOKEN = (os.getenv("METRICS_TOKEN") or "").strip()
+PROFILE_SECONDS = int(os.getenv("PROFILE_SECONDS", "30"))   # /profile без аргумента и кнопка в панели
+PROFILE_MAX_SECONDS = 300
+METRICS_PUSH_EVERY = 5.0   # как часто воркеры шардов отдают снимок метрик фронту, сек
+
+METRICS = metrics.Registry()
+HANDLER_SECONDS = METRICS.histogram("quiz_handler_seconds", "Update handler latency", ["handler"])
+HANDLER_ERRORS  = METRICS.counter("quiz_handler_errors_total", "Update handler exceptions", ["handler"])
+BOT_API_SECONDS = METRICS.histogram("quiz_bot_api_seconds", "Bot API call latency", ["method"])
+BOT_API_ERRORS  = METRICS.counter("quiz_bot_api_errors_total", "Failed Bot API calls", ["method", "code"])
+DB_SECONDS      = METRICS.histogram(
+    "quiz_db_query_seconds", "SQLite query and write batch time", ["query"],
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 1.0),
+)
+REPORT_SECONDS  = METRICS.histogram(
+    "quiz_report_build_seconds", "Excel report build time",
+    buckets=(0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0),
+)
+EXPORT_SECONDS  = METRICS.histogram(
+    "quiz_export_build_seconds", "Streaming CSV/JSONL export build time",
+    buckets=(0.1, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0),
+)
+METRICS.gauge("quiz_active_users", "Attempts held in memory", fn=lambda: len(STATE))
+METRICS.gauge("quiz_question_timers", "Pending question timers", fn=lambda: TIMERS.pending)
+METRICS.gauge("quiz_outbox_pending", "Queued outgoing Bot API calls", fn=lambda: OUTBOX.pending)
+METRICS.gauge("quiz_db_write_queue", "Operations waiting for the DB writer", fn=lambda: WRITER.pending)
+METRICS.gauge("quiz_startup_seconds", "Process start to serving updates", fn=lambda: STARTUP.total)
+set_query_observer(lambda name, seconds: DB_SECONDS.observe(seconds, name))
+
+def metered(handler):
+    """Обёртка обработчика апдейтов: время и исключения по имени обработчика."""
+    name = handler.__name__
+
+    @functools.wraps(handler)
+    async def wrapper(update, ctx):
+        t0 = time.perf_counter()
+        try:
+            return await handler(update, ctx)
+        except Exception:
+            HANDLER_ERRORS.inc(name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - t0, name)
+            if not STARTUP.served:
+                STARTUP.first_update()
+    return wrapper
+
+class MeteredRequest(HTTPXRequest):
+    """HTTPXRequest с замером каждого вызова Bot API (время, ошибки по методу и коду)."""
+
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        t0 = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+        except Exception:
+            BOT_API_ERRORS.inc(api_method, "network")
+            raise
+        finally:
+            BOT_API_SECONDS.observe(time.perf_counter() - t0, api_method)
+        if code >= 400:
+            BOT_API_ERRORS.inc(api_method, code)
+        return code, payload
+
 # ---------- МОДЕЛИ ----------
-@dataclass
+# Вопрос «компилируется» один раз при первом обращении: всё, что раньше собиралось
+# на каждую отправку/ответ, хранится готовым, горячий путь только читает поля.
+@dataclass(frozen=True)
 class Question:
     text: str
-    options: List[str]
-    correct: List[int]
+    options: Tuple[str, ...]
+    correct: Tuple[int, ...]
     multiple: bool
+    mask: int                  # правильные варианты битами — сравнение ответа одной операцией
+    labels: Tuple[str, ...]    # «A. вариант», «B. вариант», …
+    body: str                  # текст опроса без заголовка «Вопрос i/N» (номер — по билету)
+    correct_text: str          # готовая строка правильных вариантов
+
+    def fmt(self, indices) -> str:
+        parts = [self.labels[i] for i in indices if 0 <= i < len(self.labels)]
+        return "; ".join(parts) if parts else "—"
+
+Pools = Dict[Tuple[str, int], Tuple[int, ...]]   # (тема, сложность) -> номера вопросов в банке
+
+class QuestionBank:
+    """Версия банка вопросов. В памяти только номера вопросов по пулам (тема, сложность);
+    сами вопросы читаются из SQLite (bank_questions) по номеру через общий LRU-кэш."""
+    __slots__ = ("sha", "bank_id", "pools", "size", "_population", "_full")
+
+    def __init__(self, sha: str, bank_id: int = 0, pools: Optional[Pools] = None):
+        self.sha = sha           # sha256 канонического JSON банка
+        self.bank_id = bank_id   # id версии в таблице banks (0 — пустой банк)
+        self.pools = pools or {}
+        self.size = sum(len(v) for v in self.pools.values())
+        self._population: Dict[Optional[int], Tuple[int, ...]] = {}
+        self._full: Optional["Paper"] = None
+
+    @property
+    def version(self) -> str:
+        return f"v{self.bank_id}-{self.sha[:8]}"
+
+    def __len__(self) -> int:
+        return self.size
+
+    def __getitem__(self, i: int) -> Question:
+        return _load_question(self.bank_id, i)
+
+    def population(self, difficulty: Optional[int] = None) -> Tuple[int, ...]:
+        """Номера вопросов (по порядку банка) с учётом PAPER_TOPICS; difficulty=None — любые."""
+        out = self._population.get(difficulty)
+        if out is None:
+            out = self._population[difficulty] = tuple(sorted(
+                i for (topic, level), idx in self.pools.items()
+                if (not PAPER_TOPICS or topic in PAPER_TOPICS) and (difficulty is None or level == difficulty)
+                for i in idx
+            ))
+        return out
+
+    def full_paper(self) -> "Paper":
+        """Весь банк по порядку без перемешивания — один общий билет на всех."""
+        if self._full is None:
+            self._full = Paper(self, tuple(range(self.size)), None)
+        return self._full
+
+class Paper:
+    """Билет: какие вопросы банка (items — номера в банке) в каком порядке и seed перестановки
+    вариантов (None — варианты как в банке). Позиция в билете — это s.index участника."""
+    __slots__ = ("bank", "items", "seed")
+
+    def __init__(self, bank: QuestionBank, items: Tuple[int, ...], seed: Optional[int]):
+        self.bank = bank
+        self.items = items
+        self.seed = seed
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def question(self, pos: int) -> Question:
+        return self.bank[self.items[pos]]
+
+    def perm(self, pos: int) -> Optional[List[int]]:
+        """Показанный вариант j — это исходный вариант perm[j]."""
+        if self.seed is None:
+            return None
+        order = list(range(len(self.question(pos).options)))
+        random.Random(self.seed * 1_000_003 + self.items[pos]).shuffle(order)
+        return order
+
+    def poll_text(self, pos: int) -> str:
+        return f"Вопрос {pos + 1}/{len(self.items)}\n{self.question(pos).body}"
+
+    def options(self, pos: int) -> Tuple[str, ...]:
+        q, perm = self.question(pos), self.perm(pos)
+        return q.options if perm is None else tuple(q.options[i] for i in perm)
+
+    def to_original(self, pos: int, option_ids) -> List[int]:
+        perm = self.perm(pos)
+        return list(option_ids) if perm is None else [perm[j] for j in option_ids if 0 <= j < len(perm)]
+
+    def fmt(self, pos: int, indices) -> str:
+        """Исходные номера вариантов → подписи с буквами, которые видел участник."""
+        q, perm = self.question(pos), self.perm(pos)
+        if perm is None:
+            return q.fmt(indices)
+        shown = sorted(perm.index(i) for i in indices if 0 <= i < len(q.options))
+        parts = [f"{chr(0x41 + j)}. {q.options[perm[j]]}" for j in shown]
+        return "; ".join(parts) if parts else "—"
+
+    def correct_text(self, pos: int) -> str:
+        return self.question(pos).correct_text if self.seed is None else self.fmt(pos, self.question(pos).correct)
+
+BANK = QuestionBank(hashlib.sha256(b"[]").hexdigest())
 
-@dataclass
 class UserQuizState:
-    index: int = 0
-    last_poll_id: Optional[str] = None
-    started: bool = False
-    finished: bool = False
-
-QUESTIONS: List[Question] = []
+    """Состояние попытки. На раунд в 100k+ участников объектов много, поэтому без __dict__:
+    __slots__, флаги упакованы в одно число, id опроса (у Telegram — десятичное число)
+    хранится как int, если переводится туда и обратно без потерь. Завершившие попытку из памяти выселяются (всё уже в БД)."""
+    __slots__ = ("index", "bank", "_poll", "_flags")
+    _STARTED, _FINISHED = 1, 2
+
+    def __init__(self, index: int = 0, last_poll_id: Optional[str] = None, started: bool = False,
+                 finished: bool = False, bank: Optional[QuestionBank] = None):
+        self.index = index
+        self.bank = bank if bank is not None else BANK   # версия, на которой идёт попытка
+        self.last_poll_id = last_poll_id
+        self._flags = (self._STARTED if started else 0) | (self._FINISHED if finished else 0)
+
+    @property
+    def last_poll_id(self) -> Optional[str]:
+        return None if self._poll is None else str(self._poll)
+
+    @last_poll_id.setter
+    def last_poll_id(self, poll_id: Optional[str]):
+        # int — только если обратно получается та же строка: «0123» или не-ASCII цифры храним как есть
+        if poll_id is not None and poll_id.isascii() and poll_id.isdigit() and str(int(poll_id)) == poll_id:
+            self._poll = int(poll_id)
+        else:
+            self._poll = poll_id
+
+    def is_current(self, poll_id: str) -> bool:
+        return self._poll is not None and self.last_poll_id == poll_id
+
+    def _flag(self, bit: int, on: bool):
+        self._flags = self._flags | bit if on else self._flags & ~bit
+
+    @property
+    def started(self) -> bool:
+        return bool(self._flags & self._STARTED)
+
+    @started.setter
+    def started(self, on: bool):
+        self._flag(self._STARTED, on)
+
+    @property
+    def finished(self) -> bool:
+        return bool(self._flags & self._FINISHED)
+
+    @finished.setter
+    def finished(self, on: bool):
+        self._flag(self._FINISHED, on)
+
+    def __repr__(self) -> str:
+        return (f"UserQuizState(index={self.index}, last_poll_id={self.last_poll_id!r}, "
+                f"started={self.started}, finished={self.finished}, bank={self.bank.version})")
+
+# Только незавершённые попытки: завершившие выселяются в send_next (ответы и запись
+# журнала о завершении к этому моменту уже в очереди на запись)
 STATE: Dict[int, UserQuizState] = {}
 
 # ---------- БАЗА ----------
-def db():
-    conn = sqlite3.connect(DB_FILE)
-    conn.execute("""CREATE TABLE IF NOT EXISTS users(
-        user_id INTEGER PRIMARY KEY,
-        country TEXT
-    )""")
-    conn.execute("""CREATE TABLE IF NOT EXISTS answers(
-        user_id INTEGER,
-        q_index INTEGER,
-        option_ids TEXT,  -- JSON list[int]
-        correct INTEGER
-    )""")
-    return conn
+# Соединение открывается один раз в build_app(), схема создаётся там же.
+# Чтение — через STORE (на loop), запись — через WRITER (пачками в отдельном потоке).
+STORE = Storage(DB_FILE)
+WRITER = WriteBehind(DB_FILE, max_delay=DB_FLUSH_MS / 1000)
+ROUND_ID = 1   # текущий раунд; читается из БД в build_app()
+
+# Шарды (WORKERS > 1): пользователь живёт в воркере user_id % SHARDS — там его STATE,
+# таймеры и исходящая очередь. Общая у воркеров только SQLite.
+SHARD = 0
+SHARDS = 1
+SHARD_QUEUES: list = []   # входные очереди всех воркеров; пусто в однопроцессном режиме
+
+def owns(uid: int) -> bool:
+    return uid % SHARDS == SHARD
+
+def fanout(op: str, *args):
+    """Управляющее сообщение остальным шардам (старт раунда, сброс, смена банка)."""
+    for i, q in enumerate(SHARD_QUEUES):
+        if i != SHARD:
+            q.put(("control", op, args))
+
+def shard_label() -> str:
+    return f"Шард {SHARD + 1}/{SHARDS}. " if SHARDS > 1 else ""
 
 def is_admin(uid: int) -> bool:
     return uid in ADMIN_IDS
 
 def get_registered_users() -> List[int]:
-    with db() as conn:
-        rows = conn.execute("SELECT user_id FROM users WHERE country IS NOT NULL").fetchall()
-    return [r[0] for r in rows]
+    return STORE.registered_users(ROUND_ID)
 
 # ---------- ВОПРОСЫ ----------
-def _validate_questions(data: List[dict]) -> List[Question]:
-    out: List[Question] = []
+def _canonical_sha(data) -> str:
+    raw = json.dumps(data, ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+def _compile_question(text: str, options: List[str], correct: List[int], multiple: bool) -> Question:
+    labels = tuple(f"{chr(0x41+k)}. {opt}" for k, opt in enumerate(options))  # A., B., C. ...
+    suffix = " (несколько ответов)" if multiple else ""
+    rules = f"\n⏱ На ответ даётся {QUESTION_SECONDS} секунд."
+    q = Question(
+        text=text,
+        options=tuple(options),
+        correct=tuple(correct),
+        multiple=multiple,
+        mask=options_mask(correct),
+        labels=labels,
+        body=f"{text}{suffix}{rules}",
+        correct_text="",
+    )
+    return replace(q, correct_text=q.fmt(correct))
+
+def _validate_questions(data: List[dict]) -> Tuple[str, List[BankQuestionRow]]:
+    """Проверяет весь банк; возвращает (sha, строки для bank_questions)."""
+    rows: List[BankQuestionRow] = []
     if not isinstance(data, list):
         raise ValueError("Root of questions JSON must be a list.")
     for i, q in enumerate(data, start=1):
@@ -107,6 +465,8 @@ def _validate_questions(data: List[dict]) -> List[Question]:
         options = q.get("options") or []
         correct = q.get("correct_indices") or []
         multiple = bool(q.get("multiple", False))
+        topic = q.get("topic") or ""
+        difficulty = q.get("difficulty", 0)
         if not text or not isinstance(options, list) or len(options) < 2:
             raise ValueError(f"Q{i}: invalid text/options")
         if not isinstance(correct, list) or not all(isinstance(ci, int) for ci in correct):
@@ -117,30 +477,204 @@ def _validate_questions(data: List[dict]) -> List[Question]:
             raise ValueError(f"Q{i}: at least one correct answer required")
         if len(correct) > 1 and not multiple:
             raise ValueError(f"Q{i}: multiple answers but multiple=false")
-        out.append(Question(text, options, correct, multiple))
-    return out
+        if not isinstance(topic, str) or not isinstance(difficulty, int):
+            raise ValueError(f"Q{i}: topic must be a string, difficulty an integer")
+        payload = {"text": text, "options": options, "correct_indices": correct, "multiple": multiple}
+        rows.append((i - 1, topic, difficulty, json.dumps(payload, ensure_ascii=False)))
+    return _canonical_sha(data), rows
+
+def paper_config_problems(bank: QuestionBank) -> List[str]:
+    """Сверка PAPER_TOPICS / PAPER_MIX / PAPER_SIZE с банком: чего в нём не хватает для билета."""
+    if not bank:
+        return []
+    problems = []
+    topics = {topic for topic, _ in bank.pools}
+    missing = sorted(PAPER_TOPICS - topics)
+    if missing:
+        problems.append(f"PAPER_TOPICS: no questions with topics {', '.join(missing)}")
+    for difficulty, count in PAPER_MIX:
+        available = len(bank.population(difficulty))
+        if available < count:
+            problems.append(f"PAPER_MIX: difficulty {difficulty} wants {count} questions, "
+                            f"bank has {available}" + (" (with PAPER_TOPICS)" if PAPER_TOPICS else ""))
+    if not PAPER_MIX and PAPER_SIZE > len(bank.population()):
+        problems.append(f"PAPER_SIZE: {PAPER_SIZE} questions wanted, bank has {len(bank.population())}")
+    return problems
+
+def _pools(index_rows) -> Pools:
+    """[(тема, сложность, q_index)…] → пулы номеров по (тема, сложность)."""
+    pools: Dict[Tuple[str, int], List[int]] = {}
+    for topic, difficulty, q_index in index_rows:
+        pools.setdefault((topic, difficulty), []).append(q_index)
+    return {k: tuple(sorted(v)) for k, v in pools.items()}
+
+def _compile_bank(data) -> QuestionBank:
+    """Валидация + фиксация версии в БД (банк и вопросы по строкам). Безопасно вызывать вне event loop."""
+    sha, rows = _validate_questions(data)
+    # версия банка фиксируется в БД, ответы ссылаются на неё по bank_id
+    bank_id = STORE.save_bank(sha, json.dumps(data, ensure_ascii=False), rows)
+    return QuestionBank(sha, bank_id, _pools((topic, level, i) for i, topic, level, _ in rows))
+
+@functools.lru_cache(maxsize=QUESTION_CACHE_SIZE)
+def _load_question(bank_id: int, q_index: int) -> Question:
+    data = STORE.bank_question(bank_id, q_index)
+    if data is None:
+        raise KeyError(f"question {q_index} of bank {bank_id} not found")
+    q = json.loads(data)
+    return _compile_question(q["text"], q["options"], q["correct_indices"], q["multiple"])
+
+def _paper_seed(bank: QuestionBank, round_id: int, key: int) -> int:
+    raw = f"{bank.sha}:{round_id}:{key}".encode("utf-8")
+    return int.from_bytes(hashlib.blake2b(raw, digest_size=8).digest(), "big")
+
+@functools.lru_cache(maxsize=PAPER_CACHE_SIZE)
+def _sample_paper(bank: QuestionBank, round_id: int, key: int) -> Paper:
+    seed = _paper_seed(bank, round_id, key)
+    rng = random.Random(seed)
+    if PAPER_MIX:
+        items: List[int] = []
+        for difficulty, count in PAPER_MIX:
+            population = bank.population(difficulty)
+            items.extend(rng.sample(population, min(count, len(population))))
+    elif PAPER_SIZE and PAPER_SIZE < len(bank.population()):
+        items = rng.sample(bank.population(), PAPER_SIZE)
+    else:
+        items = list(bank.population())
+    return Paper(bank, tuple(items), seed if SHUFFLE_OPTIONS else None)
+
+def paper_for(bank: QuestionBank, key: int, round_id: Optional[int] = None) -> Paper:
+    """Билет участника (key — user_id; в групповом режиме — id группы). Выборка и
+    перестановки зависят только от (банк, раунд, key): одинаковы в любом процессе и после рестарта."""
+    if not (PAPER_SIZE or PAPER_MIX or PAPER_TOPICS or SHUFFLE_OPTIONS):
+        return bank.full_paper()
+    return _sample_paper(bank, ROUND_ID if round_id is None else round_id, key)
+
+# Кэш банка (JSON): на старте вместо разбора, валидации, sha и записи в БД — готовые пулы
+# номеров вопросов для версии банка sha. Запись действительна, пока файл вопросов тот же
+# (mtime/размер) и в БД есть эта версия; иначе — обычная загрузка.
+BANK_CACHE_FORMAT = 3
+
+def _bank_cache_key() -> list:
+    st_ = os.stat(QUESTIONS_FILE)
+    return [st_.st_mtime_ns, st_.st_size]
+
+def _read_bank_cache(key: list) -> Optional[QuestionBank]:
+    try:
+        with open(BANK_CACHE_FILE, "r", encoding="utf-8") as f:
+            cached = json.load(f)
+        if cached.get("format") != BANK_CACHE_FORMAT or cached.get("file") != key:
+            return None
+        sha, bank_id = str(cached["sha"]), int(cached["bank_id"])
+        pools = {(str(topic), int(level)): tuple(int(i) for i in idx) for topic, level, idx in cached["pools"]}
+    except (OSError, ValueError, KeyError, TypeError):
+        return None
+    if not STORE.has_bank(bank_id, sha):
+        return None
+    return QuestionBank(sha, bank_id, pools)
+
+def _write_bank_cache(key: list, bank: QuestionBank):
+    # шарды на холодном кэше пишут одновременно: у каждого свой временный файл,
+    # os.replace атомарен — побеждает последний, содержимое у всех одинаковое
+    tmp = f"{BANK_CACHE_FILE}.{os.getpid()}.tmp"
+    cached = {
+        "format": BANK_CACHE_FORMAT,
+        "file": key,
+        "sha": bank.sha,
+        "bank_id": bank.bank_id,
+        "pools": [[topic, level, list(idx)] for (topic, level), idx in bank.pools.items()],
+    }
+    try:
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(cached, f, ensure_ascii=False, separators=(",", ":"))
+        os.replace(tmp, BANK_CACHE_FILE)
+    except OSError as e:
+        log.warning("Bank cache not written: %s", e)
+        try:
+            os.unlink(tmp)
+        except OSError:
+            pass
 
-def load_questions_from_file() -> int:
-    global QUESTIONS
+def read_questions_file() -> Optional[QuestionBank]:
     if not os.path.exists(QUESTIONS_FILE):
-        QUESTIONS = []
-        log.warning("%s not found. No questions loaded.", QUESTIONS_FILE)
-        return 0
+        return None
+    key = _bank_cache_key()
+    bank = _read_bank_cache(key)
+    if bank is not None:
+        return bank
     with open(QUESTIONS_FILE, "r", encoding="utf-8") as f:
         data = json.load(f)
-    QUESTIONS = _validate_questions(data)
-    log.info("Loaded %d questions.", len(QUESTIONS))
-    return len(QUESTIONS)
-
-async def set_questions_from_url(url: str) -> int:
-    async with httpx.AsyncClient(timeout=30) as client:
-        r = await client.get(url)
-        r.raise_for_status()
-        data = r.json()
-    _ = _validate_questions(data)
-    with open(QUESTIONS_FILE, "w", encoding="utf-8") as f:
-        json.dump(data, f, ensure_ascii=False, indent=2)
-    return load_questions_from_file()
+    bank = _compile_bank(data)
+    _write_bank_cache(key, bank)
+    return bank
+
+def activate_bank(bank: Optional[QuestionBank]) -> int:
+    """Атомарно подменяет банк для новых попыток; начатые остаются на своей версии (s.bank)."""
+    global BANK
+    if bank is None:
+        BANK = QuestionBank(_canonical_sha([]))
+        log.warning("%s not found. No questions loaded.", QUESTIONS_FILE)
+        return 0
+    BANK = bank
+    log.info("Loaded %d questions (bank %s).", len(BANK), BANK.version)
+    for problem in paper_config_problems(BANK):
+        log.error("Paper config does not fit bank %s: %s — papers will be shorter", BANK.version, problem)
+    return len(BANK)
+
+def load_questions_from_file() -> int:
+    return activate_bank(read_questions_file())
+
+async def reload_questions() -> int:
+    """/reload без блокировки loop: чтение и компиляция — в потоке, подмена — на loop."""
+    n = activate_bank(await asyncio.to_thread(read_questions_file))
+    fanout("bank", BANK.bank_id)
+    return n
+
+# Общий HTTP-клиент (пул соединений) + валидаторы для условных GET по URL
+HTTP: Optional[httpx.AsyncClient] = None
+_URL_VALIDATORS: Dict[str, Dict[str, str]] = {}
+
+def http_client() -> httpx.AsyncClient:
+    global HTTP
+    if HTTP is None or HTTP.is_closed:
+        HTTP = httpx.AsyncClient(timeout=30, follow_redirects=True)
+    return HTTP
+
+def _write_questions_file(raw: bytes):
+    tmp = QUESTIONS_FILE + ".tmp"
+    with open(tmp, "wb") as f:
+        f.write(raw)
+    os.replace(tmp, QUESTIONS_FILE)
+
+def _prepare_downloaded_bank(raw: bytes) -> QuestionBank:
+    bank = _compile_bank(json.loads(raw))
+    _write_questions_file(raw)
+    _write_bank_cache(_bank_cache_key(), bank)
+    return bank
+
+async def set_questions_from_url(url: str) -> Tuple[int, bool]:
+    """Скачивает банк по URL. Возвращает (число вопросов, изменился ли банк)."""
+    headers = {}
+    cached = _URL_VALIDATORS.get(url, {})
+    if cached.get("sha") == BANK.sha:
+        if cached.get("etag"):
+            headers["If-None-Match"] = cached["etag"]
+        if cached.get("last_modified"):
+            headers["If-Modified-Since"] = cached["last_modified"]
+    r = await http_client().get(url, headers=headers)
+    if r.status_code == 304:
+        return len(BANK), False
+    r.raise_for_status()
+    bank = await asyncio.to_thread(_prepare_downloaded_bank, r.content)
+    _URL_VALIDATORS[url] = {
+        "etag": r.headers.get("ETag", ""),
+        "last_modified": r.headers.get("Last-Modified", ""),
+        "sha": bank.sha,
+    }
+    changed = bank.sha != BANK.sha
+    n = activate_bank(bank)
+    if changed:
+        fanout("bank", BANK.bank_id)
+    return n, changed
 
 # ---------- СОСТОЯНИЕ ----------
 def st(uid: int) -> UserQuizState:
@@ -149,34 +683,465 @@ def st(uid: int) -> UserQuizState:
     return STATE[uid]
 
 def reset_user(uid: int):
-    STATE.pop(uid, None)
-    with db() as conn:
-        conn.execute("DELETE FROM answers WHERE user_id=?", (uid,))
-
-def reset_all():
-    """Полный сброс: ответы, регистрация стран, состояние."""
+    s = STATE.pop(uid, None)
+    if s is not None and s.last_poll_id:
+        TIMERS.cancel((uid, s.last_poll_id))
+    WRITER.drop_state(uid)
+    WRITER.delete_user_answers(ROUND_ID, uid)
+
+def journal_state(uid: int, s: UserQuizState, deadline: Optional[float] = None):
+    """Пишет переход состояния в журнал (state_log). deadline — unix-время истечения опроса."""
+    poll_id = None if s.finished else s.last_poll_id
+    WRITER.log_state((uid, ROUND_ID, s.bank.bank_id, s.index, poll_id, deadline, s.finished))
+
+def _bank_by_id(bank_id: int, cache: Dict[int, QuestionBank]) -> Optional[QuestionBank]:
+    if bank_id == BANK.bank_id:
+        return BANK
+    if bank_id not in cache:
+        cache[bank_id] = _load_bank(bank_id)
+    return cache[bank_id]
+
+def _load_bank(bank_id: int) -> Optional[QuestionBank]:
+    index = STORE.bank_index(bank_id)
+    if index is None:
+        return None
+    sha, rows = index
+    if not rows:   # банк сохранён до bank_questions — раскладываем по строкам один раз
+        data = STORE.load_bank(bank_id)
+        sha, questions = _validate_questions(json.loads(data))
+        STORE.save_bank_questions(bank_id, questions)
+        rows = [(topic, level, i) for i, topic, level, _ in questions]
+    return QuestionBank(sha, bank_id, _pools(rows))
+
+def restore_state() -> List[Tuple[int, str, float]]:
+    """Поднимает STATE из журнала после рестарта. Возвращает открытые опросы
+    (uid, poll_id, deadline) — их таймеры нужно завести заново."""
+    t0 = time.monotonic()
+    banks: Dict[int, QuestionBank] = {}
+    open_polls = []
+    for uid, _, bank_id, index, poll_id, deadline, finished in STORE.load_state(ROUND_ID):
+        if finished or not owns(uid):
+            continue   # завершённые в память не поднимаем, чужой шард — тоже
+        bank = _bank_by_id(bank_id, banks)
+        if bank is None:
+            log.warning("Bank %s of user %s is gone, attempt not restored", bank_id, uid)
+            continue
+        STATE[uid] = UserQuizState(index=index, last_poll_id=poll_id, started=True, bank=bank)
+        if poll_id:
+            open_polls.append((uid, poll_id, deadline or 0.0))
+    WRITER.compact_state()
+    log.info("Restored %d attempts (%d open polls) in %.3fs",
+             len(STATE), len(open_polls), time.monotonic() - t0)
+    return open_polls
+
+def reset_memory():
     STATE.clear()
-    with db() as conn:
-        conn.execute("DELETE FROM answers")
-        conn.execute("DELETE FROM users")
+    TIMERS.clear()
+    GROUP_POLLS.clear()   # поздние голоса в опросах прошлого раунда не засчитываются в новый
+    GROUP_VOTERS.clear()
+
+async def stop_round_tasks() -> int:
+    """Рассылка старта и викторина в группе пишут ответы под текущим ROUND_ID — перед сменой
+    раунда их останавливаем. Возвращает число остановленных задач."""
+    tasks = [t for t in (BROADCAST_TASK, GROUP_TASK) if t is not None and not t.done()]
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    return len(tasks)
+
+async def reset_all() -> Tuple[int, int]:
+    """Полный сброс = новый раунд (на всех шардах): регистрации и ответы начинаются с нуля,
+    прошлые раунды остаются в базе для отчётов. Идущие рассылка старта и викторина в группе
+    останавливаются. Возвращает (номер нового раунда, число остановленных задач)."""
+    global ROUND_ID
+    stopped = await stop_round_tasks()
+    reset_memory()
+    ROUND_ID = STORE.new_round()
+    fanout("reset", ROUND_ID)
+    schedule_archive()
+    log.info("Round %d opened (%d running round tasks stopped)", ROUND_ID, stopped)
+    return ROUND_ID, stopped
+
+ARCHIVE_TASK: Optional[asyncio.Task] = None
+
+async def archive_old_rounds():
+    """Раунды старше ROUND_KEEP: пометка «архивный» и удаление сырых строк порциями
+    в своём соединении — короткие транзакции, писатель ответов не ждёт."""
+    store = Storage(DB_FILE).open(init_schema=False)
+    try:
+        while True:
+            old = STORE.rounds_to_purge(ROUND_KEEP)   # дочищенные не просматриваются заново
+            if not old:
+                return
+            for rid in old:
+                t0, n = time.monotonic(), 0
+                await asyncio.to_thread(store.archive_round, rid)
+                while True:
+                    purged = await asyncio.to_thread(store.purge_round, rid, ROUND_PURGE_CHUNK)
+                    if not purged:
+                        break
+                    n += purged
+                    await asyncio.sleep(0.05)
+                if n:
+                    log.info("Round %d archived: %d rows purged in %.1fs", rid, n, time.monotonic() - t0)
+    finally:
+        store.close()
+
+def schedule_archive():
+    """Запускается при старте и после каждого нового раунда; отменяется в on_stop."""
+    global ARCHIVE_TASK
+    if ARCHIVE_TASK is None or ARCHIVE_TASK.done():
+        ARCHIVE_TASK = asyncio.get_running_loop().create_task(archive_old_rounds())
+
+# ---------- ИСХОДЯЩИЕ СООБЩЕНИЯ ----------
+class RateLimiter:
+    """Токен-бакет на весь бот + GCRA на каждый чат (интервал с небольшим запасом на пачку)."""
+
+    def __init__(self, rate: float, burst: int, per_chat_interval: float, per_chat_burst: int = 1):
+        self.rate = rate
+        self.burst = burst
+        self.per_chat_interval = per_chat_interval
+        self.per_chat_slack = per_chat_interval * max(0, per_chat_burst - 1)
+        self._tokens = float(burst)
+        self._stamp = time.monotonic()
+        self._chat_tat: Dict[int, float] = {}   # «теоретическое время» следующего сообщения в чат
+
+    def _refill(self):
+        now = time.monotonic()
+        self._tokens = min(self.burst, self._tokens + (now - self._stamp) * self.rate)
+        self._stamp = now
+
+    def chat_delay(self, chat_id: int) -> float:
+        """Сколько секунд чату ещё нельзя писать (0 — можно сейчас)."""
+        tat = self._chat_tat.get(chat_id)
+        if tat is None:
+            return 0.0
+        return max(0.0, tat - time.monotonic() - self.per_chat_slack)
+
+    def take_chat(self, chat_id: int):
+        now = time.monotonic()
+        self._chat_tat[chat_id] = max(self._chat_tat.get(chat_id, now), now) + self.per_chat_interval
+
+    async def acquire(self):
+        """Общий токен бота. Очередь чата (chat_delay/take_chat) ведёт Outbox при выборе задачи."""
+        while True:
+            self._refill()
+            if self._tokens >= 1:
+                self._tokens -= 1
+                return
+            await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def refund(self):
+        """Вернуть неизрасходованный токен (задачи для него не нашлось)."""
+        self._refill()
+        self._tokens = min(float(self.burst), self._tokens + 1)
+
+    def share(self, parts: int):
+        """Доля общего лимита бота для одного из parts процессов (лимит чата не делится:
+        каждый чат живёт ровно в одном шарде)."""
+        self.rate /= parts
+        self.burst = max(1, self.burst // parts)
+        self._tokens = min(self._tokens, float(self.burst))
+
+    def forget_idle(self):
+        now = time.monotonic()
+        for chat_id in [c for c, t in self._chat_tat.items() if t < now]:
+            del self._chat_tat[chat_id]
+
+LIMITER = RateLimiter(BROADCAST_RATE, BROADCAST_BURST, PER_CHAT_INTERVAL, PER_CHAT_BURST)
+
+# Полосы приоритета: вопрос и «время вышло» → отзыв на ответ → салют, сводки
+PRIO_CRITICAL, PRIO_FEEDBACK, PRIO_COSMETIC = 0, 1, 2
+
+@dataclass
+class _OutJob:
+    prio: int
+    call: Callable[[], Awaitable]
+    fut: "asyncio.Future"
+    expires: Optional[float] = None
+    tries: int = 0
+
+def _retry_after_seconds(e: RetryAfter) -> float:
+    ra = e.retry_after
+    return ra.total_seconds() if hasattr(ra, "total_seconds") else float(ra)
+
+class Outbox:
+    """Единая очередь исходящих вызовов Bot API.
+
+    Порядок внутри чата — строго FIFO; между чатами первым идёт чат с самым важным
+    сообщением в очереди (вопрос «протаскивает» стоящий перед ним отзыв). Общий
+    токен-бакет + лимит на чат, повтор после RetryAfter с глобальной паузой.
+    """
+
+    def __init__(self, limiter: RateLimiter, workers: int):
+        self.limiter = limiter
+        self.workers = workers
+        self._chats: Dict[int, Deque[_OutJob]] = {}
+        self._heap: List[Tuple[int, int, int]] = []     # (prio, seq, chat_id)
+        self._queued: Dict[int, int] = {}               # chat_id -> prio его записи в куче
+        self._busy: Set[int] = set()                    # чаты с вызовом «в полёте»
+        self._seq = itertools.count()
+        self._wake = asyncio.Event()
+        self._paused_until = 0.0
+        self._tasks: List[asyncio.Task] = []
+        self.sent = [0, 0, 0]
+        self.dropped = 0
+        self.retried = 0
+
+    @property
+    def pending(self) -> int:
+        return sum(len(q) for q in self._chats.values())
+
+    # ---------- постановка ----------
+    def submit(self, prio: int, chat_id: int, call: Callable[[], Awaitable],
+               ttl: Optional[float] = None) -> "asyncio.Future":
+        fut = asyncio.get_running_loop().create_future()
+        expires = time.monotonic() + ttl if ttl else None
+        self._chats.setdefault(chat_id, deque()).append(_OutJob(prio, call, fut, expires))
+        self._schedule(chat_id, prio)
+        return fut
+
+    async def send(self, prio: int, chat_id: int, call: Callable[[], Awaitable], ttl: Optional[float] = None):
+        """Поставить и дождаться результата (например, Message с poll.id)."""
+        return await self.submit(prio, chat_id, call, ttl)
+
+    def post(self, prio: int, chat_id: int, call: Callable[[], Awaitable], ttl: Optional[float] = None):
+        """Поставить и не ждать; ошибка доставки только логируется."""
+        self.submit(prio, chat_id, call, ttl).add_done_callback(_log_send_failure)
+
+    def _schedule(self, chat_id: int, prio: int):
+        if chat_id in self._busy:
+            return   # перепланируем по завершении текущего вызова
+        if self._queued.get(chat_id, 99) <= prio:
+            return
+        self._queued[chat_id] = prio
+        heapq.heappush(self._heap, (prio, next(self._seq), chat_id))
+        self._wake.set()
+
+    def _reschedule(self, chat_id: int):
+        q = self._chats.get(chat_id)
+        if not q:
+            self._chats.pop(chat_id, None)
+            return
+        self._schedule(chat_id, min(j.prio for j in q))
+
+    def _pop(self) -> Optional[Tuple[int, _OutJob]]:
+        while self._heap:
+            prio, _, chat_id = heapq.heappop(self._heap)
+            if self._queued.get(chat_id) != prio or chat_id in self._busy:
+                continue   # устаревшая запись
+            del self._queued[chat_id]
+            delay = self.limiter.chat_delay(chat_id)
+            if delay > 0:
+                asyncio.get_running_loop().call_later(delay, self._reschedule, chat_id)
+                continue
+            q = self._chats.get(chat_id)
+            now = time.monotonic()
+            while q and q[0].expires is not None and q[0].expires < now:
+                job = q.popleft()
+                self.dropped += 1
+                if not job.fut.done():
+                    job.fut.set_result(None)
+            if not q:
+                self._chats.pop(chat_id, None)
+                continue
+            self._busy.add(chat_id)
+            self.limiter.take_chat(chat_id)
+            return chat_id, q.popleft()
+        return None
+
+    # ---------- отправка ----------
+    def start(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self, timeout: float = 5.0):
+        # даём дойти тому, что уже в очереди, потом останавливаем воркеров
+        t_end = time.monotonic() + timeout
+        while self.pending and time.monotonic() < t_end:
+            await asyncio.sleep(0.1)
+        for t in self._tasks:
+            t.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    async def _worker(self):
+        while True:
+            if not self._heap:
+                self.limiter.forget_idle()
+                self._wake.clear()
+                await self._wake.wait()
+                continue
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+                continue
+            await self.limiter.acquire()   # токен берём до выбора задачи: выбирается самая важная на этот момент
+            item = self._pop()
+            if item is None:
+                # все чаты в очереди ждут своего интервала или задачи истекли — токен не тратим
+                self.limiter.refund()
+                continue
+            chat_id, job = item
+            try:
+                await self._run(chat_id, job)
+            finally:
+                self._busy.discard(chat_id)
+                self._reschedule(chat_id)
+
+    async def _run(self, chat_id: int, job: _OutJob):
+        try:
+            result = await job.call()
+        except RetryAfter as e:
+            wait = _retry_after_seconds(e)
+            self.retried += 1
+            self._paused_until = max(self._paused_until, time.monotonic() + wait)
+            log.warning("Flood control: pausing outbox for %.1fs", wait)
+            job.tries += 1
+            self._chats.setdefault(chat_id, deque()).appendleft(job)
+            return
+        except NetworkError as e:   # в т.ч. TimedOut; BadRequest повторять бессмысленно
+            if job.tries < 2 and not isinstance(e, BadRequest):
+                job.tries += 1
+                self.retried += 1
+                self._chats.setdefault(chat_id, deque()).appendleft(job)
+                return
+            if not job.fut.done():
+                job.fut.set_exception(e)
+            return
+        except Exception as e:
+            if not job.fut.done():
+                job.fut.set_exception(e)
+            return
+        self.sent[job.prio] += 1
+        if not job.fut.done():
+            job.fut.set_result(result)
+
+    def text(self) -> str:
+        return (f"Исходящие: в очереди {self.pending}, отправлено "
+                f"{self.sent[PRIO_CRITICAL]}/{self.sent[PRIO_FEEDBACK]}/{self.sent[PRIO_COSMETIC]} "
+                f"(вопросы/отзывы/прочее), повторов {self.retried}, выброшено {self.dropped}")
+
+def _log_send_failure(fut: "asyncio.Future"):
+    if not fut.cancelled() and fut.exception() is not None:
+        log.warning("Send failed: %s", fut.exception())
+
+OUTBOX = Outbox(LIMITER, OUTBOX_WORKERS)
+
+# ---------- КЭШ МЕДИА (file_id) ----------
+class MediaCache:
+    """file_id файлов, уже загруженных в Telegram: один раз загрузили — дальше шлём по id.
+    Хранится в SQLite (таблица media), в памяти — копия для горячего пути.
+    Идущие загрузки — future по ключу: одновременные промахи ждут file_id первой."""
+
+    def __init__(self):
+        self._ids: Dict[str, str] = {}
+        self._uploads: Dict[str, asyncio.Future] = {}
+
+    def load(self):
+        self._ids = STORE.media_ids()
+
+    def get(self, key: str) -> Optional[str]:
+        return self._ids.get(key)
+
+    def remember(self, key: str, kind: str, file_id: str):
+        if self._ids.get(key) != file_id:
+            self._ids[key] = file_id
+            WRITER.set_media(key, kind, file_id)
+
+    def keys(self, prefix: str = "") -> List[str]:
+        return [k for k in self._ids if k.startswith(prefix)]
+
+    def invalidate(self, key: str):
+        if self._ids.pop(key, None) is not None:
+            WRITER.drop_media(key)
+
+    def upload_of(self, key: str) -> Optional[asyncio.Future]:
+        return self._uploads.get(key)
+
+    def begin_upload(self, key: str) -> asyncio.Future:
+        upload = self._uploads[key] = asyncio.get_running_loop().create_future()
+        return upload
+
+    def end_upload(self, key: str, upload: asyncio.Future, file_id: Optional[str]):
+        """file_id=None — загрузка не удалась: ждавшие загрузят сами."""
+        if self._uploads.get(key) is upload:
+            del self._uploads[key]
+        upload.set_result(file_id)
+
+MEDIA = MediaCache()
+
+def _is_bad_file_id(e: BadRequest) -> bool:
+    text = str(e).lower()
+    return "file" in text and any(w in text for w in ("identifier", "wrong", "invalid", "not found"))
+
+async def send_cached_media(bot, chat_id: int, kind: str, key: str,
+                            source: Callable[[], Awaitable], **kwargs):
+    """send_<kind> через кэш file_id. source() отдаёт исходник (URL/путь) — только при промахе.
+    Если Telegram отверг сохранённый id, он выбрасывается и файл загружается заново."""
+    send = getattr(bot, f"send_{kind}")
+    file_id = MEDIA.get(key)
+    upload = MEDIA.upload_of(key)
+    while file_id is None and upload is not None:
+        # загрузка уже идёт: ждём её file_id, а не заставляем Telegram качать файл снова;
+        # не удалась — загрузку берёт на себя первый из ждавших, остальные ждут его
+        file_id = await asyncio.shield(upload)
+        upload = MEDIA.upload_of(key)
+    if file_id:
+        try:
+            return await send(chat_id, file_id, **kwargs)
+        except BadRequest as e:
+            if not _is_bad_file_id(e):
+                raise
+            log.warning("Cached %s for %s rejected (%s), re-uploading", kind, key, e)
+            MEDIA.invalidate(key)
+    upload, file_id = MEDIA.begin_upload(key), None
+    try:
+        msg = await send(chat_id, await source(), **kwargs)
+        media = getattr(msg, kind, None)
+        if media is not None:
+            file_id = media.file_id
+            MEDIA.remember(key, kind, file_id)
+        return msg
+    finally:
+        MEDIA.end_upload(key, upload, file_id)
+
+async def _celebration_gif_source():
+    return CELEBRATION_GIF_URL
 
 # ---------- УТИЛИТЫ ДЛЯ ОТЧЁТОВ УЧАСТНИКУ ----------
-def _fmt_opts(indices: List[int], options: List[str]) -> str:
-    if not indices:
-        return "—"
-    parts = []
-    for i in indices:
-        if 0 <= i < len(options):
-            parts.append(f"{chr(0x41+i)}. {options[i]}")  # A., B., C. ...
-    return "; ".join(parts)
-
-async def send_personal_summary(uid: int, ctx: ContextTypes.DEFAULT_TYPE):
-    total_q = len(QUESTIONS)
-    with db() as conn:
-        rows = conn.execute(
-            "SELECT q_index, option_ids, correct FROM answers WHERE user_id=? ORDER BY q_index",
-            (uid,)
-        ).fetchall()
+def pack_messages(parts: List[str], limit: int = MESSAGE_LIMIT) -> List[str]:
+    """Жадно собирает части в сообщения до limit символов; слишком длинную часть режет."""
+    chunks, chunk = [], ""
+    for part in parts:
+        while len(part) > limit:
+            if chunk:
+                chunks.append(chunk)
+                chunk = ""
+            chunks.append(part[:limit])
+            part = part[limit:]
+        candidate = f"{chunk}\n{part}" if chunk else part
+        if len(candidate) > limit:
+            chunks.append(chunk)
+            candidate = part
+        chunk = candidate
+    if chunk:
+        chunks.append(chunk)
+    return chunks
+
+async def send_personal_summary(uid: int, ctx: ContextTypes.DEFAULT_TYPE, prefix: str = "",
+                                paper: Optional[Paper] = None, flush: bool = True):
+    """Личная сводка. prefix (финал/салют) в режиме склейки уходит в том же сообщении.
+    paper — билет попытки (по умолчанию билет пользователя в его версии банка); flush=False —
+    вызывающий сам дождался записи (пачка сводок группового режима)."""
+    paper = paper if paper is not None else paper_for(st(uid).bank, uid)
+    total_q = len(paper)
+    if flush:
+        await WRITER.flush()   # последний ответ мог ещё не дойти до БД
+    # ответы хранятся по номеру вопроса в банке; в сводке — порядок и буквы билета
+    positions = {qidx: pos for pos, qidx in enumerate(paper.items)}
+    rows = sorted((positions[qidx], chosen, ok) for qidx, chosen, ok in STORE.user_answers(ROUND_ID, uid)
+                  if qidx in positions)
 
     answered = len(rows)
     correct_cnt = sum(1 for _, _, ok in rows if ok)
@@ -191,169 +1156,659 @@ async def send_personal_summary(uid: int, ctx: ContextTypes.DEFAULT_TYPE):
         f"Без ответа: {unanswered}\n"
         f"Точность: {acc}%"
     )
-    await ctx.bot.send_message(uid, msg)
+    if prefix:
+        msg = f"{prefix}\n\n{msg}"
 
-    lines = ["\n🧾 Разбор по вопросам:"]
-    for qidx, opt_json, ok in rows:
-        q = QUESTIONS[qidx]
-        try:
-            chosen = json.loads(opt_json) if opt_json else []
-        except:
-            chosen = []
-        chosen_text  = _fmt_opts(chosen, q.options)
-        correct_text = _fmt_opts(q.correct, q.options)
+    lines = [msg, "\n🧾 Разбор по вопросам:"]
+    for pos, chosen, ok in rows:
         mark = "✅" if ok else "❌"
         lines.append(
-            f"{mark} Вопрос {qidx+1}: {q.text}\n"
-            f"— Ваш ответ: {chosen_text}\n"
-            f"— Правильно: {correct_text}\n"
+            f"{mark} Вопрос {pos+1}: {paper.question(pos).text}\n"
+            f"— Ваш ответ: {paper.fmt(pos, chosen)}\n"
+            f"— Правильно: {paper.correct_text(pos)}\n"
         )
 
-    chunk = ""
-    for line in lines:
-        if len(chunk) + len(line) > 3500:
-            await ctx.bot.send_message(uid, chunk)
-            chunk = ""
-        chunk += line + "\n"
-    if chunk:
-        await ctx.bot.send_message(uid, chunk)
+    for text in pack_messages(lines):
+        OUTBOX.post(PRIO_COSMETIC, uid, lambda text=text: ctx.bot.send_message(uid, text))
 
 # ---------- КВИЗ (личный чат) ----------
-async def start_user_quiz(uid: int, ctx: ContextTypes.DEFAULT_TYPE, countdown: int = COUNTDOWN):
+async def send_next(uid: int, ctx: ContextTypes.DEFAULT_TYPE,
+                    note: str = "", short_note: str = "", note_prio: int = PRIO_FEEDBACK):
+    """Следующий вопрос или финал. note — отзыв/«время вышло» по предыдущему вопросу:
+    в режиме склейки уходит в заголовке опроса (short_note — если полный не влезает)."""
     s = st(uid)
-    if s.started and not s.finished:
-        return
-    s.index = 0
-    s.finished = False
-    s.started = True
-
-    if countdown > 0:
-        msg = await ctx.bot.send_message(uid, f"🚀 Старт через {countdown}…")
-        for left in range(countdown - 1, 0, -1):
-            await asyncio.sleep(1)
-            try:
-                await msg.edit_text(f"🚀 Старт через {left}…")
-            except:
-                pass
-        try:
-            await msg.edit_text("🔥 Поехали!")
-        except:
-            await ctx.bot.send_message(uid, "🔥 Поехали!")
-
-    await send_next(uid, ctx)
-
-async def send_next(uid: int, ctx: ContextTypes.DEFAULT_TYPE):
-    s = st(uid)
-    if s.index >= len(QUESTIONS):
+    paper = paper_for(s.bank, uid)
+    thanks = "✅ Спасибо! Ваши ответы сохранены."
+    if s.index >= len(paper):
         s.finished = True
-        # Финал + салют + личная сводка
-        await ctx.bot.send_message(uid, "✅ Спасибо! Ваши ответы сохранены.")
-        if CELEBRATE:
-            try:
-                await ctx.bot.send_message(uid, CELEBRATION_TEXT)
-            except Exception as e:
-                log.warning("Celebration text failed: %s", e)
-            try:
-                await ctx.bot.send_animation(uid, CELEBRATION_GIF_URL)
-            except Exception as e:
-                log.warning("Celebration gif failed: %s", e)
+        journal_state(uid, s)
+        # Финал + салют + личная сводка (салют — косметика: под нагрузкой может устареть и не уйти)
+        if COMBINE_MESSAGES:
+            # отзыв + финал + салют + сводка одним сообщением, GIF следом
+            prefix = "\n\n".join(p for p in (note, thanks, CELEBRATION_TEXT if CELEBRATE else "") if p)
+        else:
+            prefix = ""
+            if note:
+                OUTBOX.post(note_prio, uid, lambda: ctx.bot.send_message(uid, note))
+            OUTBOX.post(PRIO_FEEDBACK, uid, lambda: ctx.bot.send_message(uid, thanks))
+            if CELEBRATE:
+                OUTBOX.post(PRIO_COSMETIC, uid, lambda: ctx.bot.send_message(uid, CELEBRATION_TEXT),
+                            ttl=COSMETIC_TTL)
+                OUTBOX.post(PRIO_COSMETIC, uid, lambda: send_cached_media(
+                    ctx.bot, uid, "animation", CELEBRATION_GIF_URL, _celebration_gif_source), ttl=COSMETIC_TTL)
         try:
-            await send_personal_summary(uid, ctx)
+            await send_personal_summary(uid, ctx, prefix, paper)
         except Exception as e:
             log.warning("Personal summary failed: %s", e)
+            if prefix:
+                OUTBOX.post(PRIO_FEEDBACK, uid, lambda: ctx.bot.send_message(uid, prefix))
+        if CELEBRATE and COMBINE_MESSAGES:
+            OUTBOX.post(PRIO_COSMETIC, uid, lambda: send_cached_media(
+                ctx.bot, uid, "animation", CELEBRATION_GIF_URL, _celebration_gif_source), ttl=COSMETIC_TTL)
+        if STATE.get(uid) is s:
+            del STATE[uid]
         return
 
-    q = QUESTIONS[s.index]
-    head = f"Вопрос {s.index+1}/{len(QUESTIONS)}"
-    suffix = " (несколько ответов)" if q.multiple else ""
-    rules = f"\n⏱ На ответ даётся {QUESTION_SECONDS} секунд."
-    text = f"{head}\n{q.text}{suffix}{rules}"
-
-    msg = await ctx.bot.send_poll(
+    question = paper.poll_text(s.index)
+    if note:
+        merged = None
+        if COMBINE_MESSAGES:
+            for candidate in (note, short_note):
+                if candidate and len(candidate) + 2 + len(question) <= POLL_QUESTION_LIMIT:
+                    merged = f"{candidate}\n\n{question}"
+                    break
+        if merged is None:
+            OUTBOX.post(note_prio, uid, lambda: ctx.bot.send_message(uid, note))
+        else:
+            question = merged
+    msg = await OUTBOX.send(PRIO_CRITICAL, uid, lambda: ctx.bot.send_poll(
         chat_id=uid,
-        question=text,
-        options=q.options,
+        question=question,
+        options=paper.options(s.index),
         is_anonymous=False,
-        allows_multiple_answers=q.multiple
-    )
+        allows_multiple_answers=paper.question(s.index).multiple
+    ))
     s.last_poll_id = msg.poll.id
+    TIMERS.schedule((uid, msg.poll.id), QUESTION_SECONDS, ctx)
+    journal_state(uid, s, time.time() + QUESTION_SECONDS)
+
+# ---------- ТАЙМЕРЫ ВОПРОСОВ ----------
+TimerKey = Tuple[int, str]   # (user_id, poll_id)
+
+class TimerWheel:
+    """Хешированное колесо таймеров: один фоновый тик вместо задачи-сна на каждый опрос.
+
+    schedule/cancel — O(1), истёкшие таймеры отдаются колбэку пачкой за тик. Пачка
+    обрабатывается своей задачей: медленная отправка или занятый замок пользователя
+    не задерживают остальные таймеры.
+    """
+
+    def __init__(self, tick: float = 0.5, slots: int = 128):
+        self.tick = tick
+        self.slots = slots
+        self._wheel: List[Dict[TimerKey, list]] = [dict() for _ in range(slots)]
+        self._where: Dict[TimerKey, int] = {}
+        self._cursor = 0
+        self._task: Optional[asyncio.Task] = None
+        self._batches: Set[asyncio.Task] = set()   # пачки, которые ещё обрабатываются
+
+    @property
+    def pending(self) -> int:
+        return len(self._where)
+
+    def schedule(self, key: TimerKey, delay: float, payload=None):
+        self.cancel(key)
+        ticks = max(1, int(-(-delay // self.tick)))   # округление вверх
+        slot = (self._cursor + ticks) % self.slots
+        self._wheel[slot][key] = [(ticks - 1) // self.slots, payload]
+        self._where[key] = slot
+
+    def cancel(self, key: TimerKey) -> bool:
+        slot = self._where.pop(key, None)
+        if slot is None:
+            return False
+        del self._wheel[slot][key]
+        return True
+
+    def clear(self):
+        for bucket in self._wheel:
+            bucket.clear()
+        self._where.clear()
+
+    def _advance(self) -> List[Tuple[TimerKey, object]]:
+        self._cursor = (self._cursor + 1) % self.slots
+        bucket = self._wheel[self._cursor]
+        fired = []
+        for key, entry in list(bucket.items()):
+            if entry[0] > 0:
+                entry[0] -= 1
+                continue
+            del bucket[key]
+            del self._where[key]
+            fired.append((key, entry[1]))
+        return fired
+
+    def start(self, on_expire):
+        """on_expire(batch) — корутина, получает список (key, payload) истёкших за тик."""
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(on_expire))
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for task in self._batches:
+            task.cancel()
+        await asyncio.gather(*self._batches, return_exceptions=True)
+
+    async def _run(self, on_expire):
+        loop = asyncio.get_running_loop()
+        next_at = loop.time() + self.tick
+        while True:
+            await asyncio.sleep(max(0.0, next_at - loop.time()))
+            # догоняем пропущенные тики, если loop был занят
+            batch = []
+            while next_at <= loop.time():
+                batch.extend(self._advance())
+                next_at += self.tick
+            if batch:
+                task = asyncio.create_task(self._dispatch(on_expire, batch))
+                self._batches.add(task)
+                task.add_done_callback(self._batches.discard)
+
+    @staticmethod
+    async def _dispatch(on_expire, batch):
+        try:
+            await on_expire(batch)
+        except Exception:
+            log.exception("Timer batch failed")
+
+TIMERS = TimerWheel()
+
+async def _expire_question(uid: int, poll_id: str, ctx: ContextTypes.DEFAULT_TYPE):
+    # тот же замок, что и у апдейтов пользователя: таймаут не гоняется с ответом
+    async with USER_LOCKS(uid):
+        s = STATE.get(uid)
+        if s is None or not s.is_current(poll_id) or s.finished:
+            return
+        s.index += 1
+        await send_next(uid, ctx, note="⏰ Время на этот вопрос вышло.", note_prio=PRIO_CRITICAL)
+
+async def on_question_timeouts(batch: List[Tuple[TimerKey, object]]):
+    results = await asyncio.gather(
+        *(_expire_question(uid, poll_id, ctx) for (uid, poll_id), ctx in batch),
+        return_exceptions=True
+    )
+    for ((uid, _), _), res in zip(batch, results):
+        if isinstance(res, Exception):
+            log.warning("Timeout handling failed for %s: %s", uid, res)
+
+# ---------- РАССЫЛКА СТАРТА ----------
+@dataclass
+class BroadcastProgress:
+    total: int = 0
+    started: int = 0
+    failed: int = 0
+    skipped: int = 0
+    finished: int = 0
+    label: str = ""
+
+    @property
+    def pending(self) -> int:
+        return self.total - self.started - self.failed - self.skipped - self.finished
+
+    def text(self, done: bool = False) -> str:
+        head = self.label + ("✅ Старт завершён." if done else "▶️ Запуск раунда…")
+        return (
+            f"{head}\n"
+            f"Запущено: {self.started}/{self.total}\n"
+            f"Ошибок: {self.failed}\n"
+            f"Уже в процессе: {self.skipped}\n"
+            f"Уже прошли (повтор — через /again): {self.finished}\n"
+            f"В очереди: {self.pending}"
+        )
 
-    async def q_timeout(poll_id: str, user_id: int):
-        await asyncio.sleep(QUESTION_SECONDS)
-        s2 = st(user_id)
-        if s2.last_poll_id == poll_id and not s2.finished:
-            await ctx.bot.send_message(user_id, "⏰ Время на этот вопрос вышло.")
-            s2.index += 1
-            await send_next(user_id, ctx)
+BROADCAST_TASK: Optional[asyncio.Task] = None
+BROADCAST_LOCK = asyncio.Lock()
 
-    asyncio.create_task(q_timeout(msg.poll.id, uid))
+async def _broadcast_one(uid: int, ctx: ContextTypes.DEFAULT_TYPE, countdown: int, progress: BroadcastProgress,
+                         answered: Set[int]):
+    s = STATE.get(uid)
+    if s is not None and s.started and not s.finished:
+        progress.skipped += 1
+        return
+    if uid in answered:
+        # завершившие вытеснены из STATE, но их ответы раунда в базе: новая попытка
+        # писала бы поверх них (DO NOTHING) — повтор только после /again
+        progress.finished += 1
+        return
+    s = st(uid)
+    s.index = 0
+    s.finished = False
+    s.started = True
+    s.bank = BANK   # попытка до конца идёт на этой версии банка
+    try:
+        # Одно сообщение вместо анонса + покадрового отсчёта: при тысячах участников
+        # правки «3…2…1» съедают общий лимит рассылки.
+        note = "Организатор запустил викторину."
+        if countdown > 0:
+            note += f"\n🚀 Старт через {countdown} сек…"
+        await OUTBOX.send(PRIO_FEEDBACK, uid, lambda: ctx.bot.send_message(uid, note))
+        if countdown > 0:
+            await asyncio.sleep(countdown)
+        async with USER_LOCKS(uid):
+            await send_next(uid, ctx)
+        progress.started += 1
+    except Exception as e:
+        s.started = False
+        progress.failed += 1
+        log.warning("Cannot start for %s: %s", uid, e)
+
+async def _report_progress(msg, progress: BroadcastProgress, done: asyncio.Event):
+    last = ""
+    while not done.is_set():
+        try:
+            await asyncio.wait_for(done.wait(), timeout=PROGRESS_EVERY)
+        except asyncio.TimeoutError:
+            pass
+        text = progress.text(done.is_set())
+        if text != last:
+            try:
+                await msg.edit_text(text)
+                last = text
+            except Exception as e:
+                log.warning("Progress update failed: %s", e)
+
+async def broadcast_start(uids: List[int], ctx: ContextTypes.DEFAULT_TYPE, admin_chat: int,
+                          answered: Set[int], countdown: int = COUNTDOWN):
+    """Запускает квиз всем uids параллельно в пределах лимитов Telegram, показывая прогресс админу."""
+    progress = BroadcastProgress(total=len(uids), label=shard_label())
+    done = asyncio.Event()
+    msg = await ctx.bot.send_message(admin_chat, progress.text())
+    reporter = asyncio.create_task(_report_progress(msg, progress, done))
+    t0 = time.monotonic()
+    try:
+        await asyncio.gather(*(_broadcast_one(u, ctx, countdown, progress, answered) for u in uids))
+    finally:
+        done.set()
+        await reporter
+    log.info("Broadcast start: %d started, %d failed, %d skipped, %d already finished in %.1fs",
+             progress.started, progress.failed, progress.skipped, progress.finished, time.monotonic() - t0)
+    if owns(admin_chat):   # панель — один раз, из шарда админа
+        await ctx.bot.send_message(admin_chat, "Панель:", reply_markup=admin_keyboard())
+
+async def launch_round(ctx: ContextTypes.DEFAULT_TYPE, admin_chat: int, fan: bool = True) -> Optional[int]:
+    """Запускает рассылку в фоне, чтобы не держать обработку остальных апдейтов.
+    Возвращает число адресатов (на всех шардах) или None, если предыдущий старт ещё идёт.
+    Каждый шард рассылает только своим пользователям."""
+    global BROADCAST_TASK
+    async with BROADCAST_LOCK:   # апдейты разных админов обрабатываются параллельно
+        if BROADCAST_TASK is not None and not BROADCAST_TASK.done():
+            return None
+        await WRITER.flush()   # регистрации последних секунд
+        uids = get_registered_users()
+        if fan:
+            fanout("launch", admin_chat)
+        mine = [u for u in uids if owns(u)]
+        answered = STORE.answered_users(ROUND_ID)
+        BROADCAST_TASK = spawn(broadcast_start(mine, ctx, admin_chat, answered))
+    return len(uids)
+
+# ---------- ГРУППОВОЙ РЕЖИМ ----------
+# Админ привязывает группу (/bind в ней). Старт в группе: каждый вопрос публикуется
+# один раз неанонимным опросом с open_period = QUESTION_SECONDS — общие часы раунда,
+# Telegram сам закрывает опрос. Голоса приходят poll_answer'ами и засчитываются по
+# poll_id; личных отзывов нет, сводки участникам — пачками после финала.
+# Шарды: ведёт викторину шард админа, poll_id рассылается остальным (fanout),
+# каждый засчитывает голоса и шлёт сводки своим пользователям. Билет у группы один
+# (paper_for по id группы) — шарды восстанавливают его из (банк, группа) сами.
+GROUP_META_KEY = "group_chat"
+GROUP_STOP_KEY = "group_interrupted"   # "раунд:опубликовано:всего" — викторину в группе прервала остановка
+GROUP_SUMMARY_BATCH = 200   # сводок в исходящей очереди одновременно
+GROUP_GRACE = 2.0           # ждём голоса, ушедшие до закрытия последнего опроса, сек
+
+GROUP_POLLS: Dict[str, Tuple[Paper, int]] = {}          # poll_id -> (билет группы, позиция)
+GROUP_VOTERS: Set[int] = set()                           # проголосовавшие (пользователи этого шарда)
+GROUP_TASK: Optional[asyncio.Task] = None
+
+def group_chat() -> Optional[int]:
+    value = STORE.get_meta(GROUP_META_KEY)
+    return int(value) if value else None
+
+async def group_paper(bank_id: int, chat_id: int) -> Optional[Paper]:
+    """Билет группы на этом шарде: тот же, что у ведущего, — из (банк, группа, раунд)."""
+    for paper, _ in GROUP_POLLS.values():
+        if paper.bank.bank_id == bank_id:
+            return paper
+    bank = BANK if bank_id == BANK.bank_id else await asyncio.to_thread(_bank_by_id, bank_id, {})
+    return paper_for(bank, chat_id) if bank is not None else None
+
+def add_group_poll(poll_id: str, paper: Paper, pos: int):
+    GROUP_POLLS[poll_id] = (paper, pos)
+
+def record_group_answer(uid: int, poll_id: str, option_ids) -> bool:
+    """Засчитывает голос в групповом опросе. False — опрос не групповой."""
+    entry = GROUP_POLLS.get(poll_id)
+    if entry is None:
+        return False
+    if option_ids:   # пустой список — голос отозван; засчитан первый
+        paper, pos = entry
+        mask = options_mask(paper.to_original(pos, option_ids))
+        WRITER.record_answer(ROUND_ID, uid, paper.items[pos], mask, mask == paper.question(pos).mask,
+                             paper.bank.bank_id)
+        GROUP_VOTERS.add(uid)
+    return True
+
+async def send_group_summaries(ctx: ContextTypes.DEFAULT_TYPE, paper: Paper) -> int:
+    """Личные сводки проголосовавшим, пачками: очередь не раздувается на всю аудиторию."""
+    voters = sorted(GROUP_VOTERS)
+    GROUP_VOTERS.clear()
+    GROUP_POLLS.clear()
+    await WRITER.flush()
+    for i in range(0, len(voters), GROUP_SUMMARY_BATCH):
+        while OUTBOX.pending > GROUP_SUMMARY_BATCH:
+            await asyncio.sleep(0.5)
+        results = await asyncio.gather(
+            *(send_personal_summary(uid, ctx, paper=paper, flush=False) for uid in voters[i:i + GROUP_SUMMARY_BATCH]),
+            return_exceptions=True
+        )
+        for uid, res in zip(voters[i:i + GROUP_SUMMARY_BATCH], results):
+            if isinstance(res, Exception):
+                log.warning("Group summary for %s failed: %s", uid, res)
+    return len(voters)
+
+async def run_group_quiz(ctx: ContextTypes.DEFAULT_TYPE, chat_id: int, admin_chat: int,
+                         countdown: int = COUNTDOWN):
+    bank = BANK
+    paper = paper_for(bank, chat_id)
+    bot = ctx.bot
+    t0 = time.monotonic()
+    intro = (f"Организатор запустил викторину: {len(paper)} вопросов, {QUESTION_SECONDS} сек на каждый.\n"
+             f"Голосуйте в опросах. Личная сводка придёт в личные сообщения "
+             f"(если вы хоть раз писали боту /start).")
+    if countdown > 0:
+        intro += f"\n🚀 Старт через {countdown} сек…"
+    note = ""
+    published = 0
+    try:
+        await OUTBOX.send(PRIO_CRITICAL, chat_id, lambda: bot.send_message(chat_id, intro))
+        if countdown > 0:
+            await asyncio.sleep(countdown)
+
+        for pos in range(len(paper)):
+            question = paper.poll_text(pos)
+            if note and len(note) + 2 + len(question) <= POLL_QUESTION_LIMIT:
+                question = f"{note}\n\n{question}"
+            elif note:
+                OUTBOX.post(PRIO_FEEDBACK, chat_id, lambda note=note: bot.send_message(chat_id, note))
+            msg = await OUTBOX.send(PRIO_CRITICAL, chat_id, lambda question=question, pos=pos: bot.send_poll(
+                chat_id=chat_id,
+                question=question,
+                options=paper.options(pos),
+                is_anonymous=False,
+                allows_multiple_answers=paper.question(pos).multiple,
+                open_period=QUESTION_SECONDS,
+            ))
+            add_group_poll(msg.poll.id, paper, pos)
+            published = pos + 1
+            fanout("group_poll", msg.poll.id, bank.bank_id, chat_id, pos)
+            await asyncio.sleep(QUESTION_SECONDS)
+            note = f"Правильно (вопрос {pos + 1}): {paper.correct_text(pos)}"
+
+        final = "\n\n".join(p for p in (note, "🏁 Викторина завершена! Личные сводки — в личных сообщениях.",
+                                          CELEBRATION_TEXT if CELEBRATE else "") if p)
+        OUTBOX.post(PRIO_FEEDBACK, chat_id, lambda: bot.send_message(chat_id, final))
+        if CELEBRATE:
+            OUTBOX.post(PRIO_COSMETIC, chat_id, lambda: send_cached_media(
+                bot, chat_id, "animation", CELEBRATION_GIF_URL, _celebration_gif_source), ttl=COSMETIC_TTL)
+        await asyncio.sleep(GROUP_GRACE)
+        fanout("group_done", bank.bank_id, chat_id)
+        n = await send_group_summaries(ctx, paper)
+        log.info("Group quiz in %s: %d questions, %d voters (this shard) in %.1fs",
+                 chat_id, len(paper), n, time.monotonic() - t0)
+    except asyncio.CancelledError:
+        # остановка процесса: голоса уже в очереди записи (дописываются при закрытии),
+        # сводки не разосланы — помечаем, докуда дошли, чтобы админ увидел это в /status
+        STORE.set_meta(GROUP_STOP_KEY, f"{ROUND_ID}:{published}:{len(paper)}")
+        log.warning("Group quiz in %s interrupted after %d/%d questions", chat_id, published, len(paper))
+        raise
+    await bot.send_message(admin_chat, f"👥 {shard_label()}Викторина в группе завершена. "
+                                       f"Сводки отправлены: {n}.", reply_markup=admin_keyboard())
+
+async def _run_group_quiz_safe(ctx: ContextTypes.DEFAULT_TYPE, chat_id: int, admin_chat: int):
+    try:
+        await run_group_quiz(ctx, chat_id, admin_chat)
+    except Exception as e:
+        log.exception("Group quiz failed")
+        await ctx.bot.send_message(admin_chat, f"Викторина в группе прервана: {e}")
+
+def launch_group_round(ctx: ContextTypes.DEFAULT_TYPE, admin_chat: int) -> str:
+    """Старт в привязанной группе (фоном). Возвращает ответ админу."""
+    global GROUP_TASK
+    chat_id = group_chat()
+    if chat_id is None:
+        return "Группа не привязана: добавьте бота в группу и отправьте там /bind."
+    if not BANK:
+        return "Нет загруженных вопросов. Используй /reload или /setq."
+    if GROUP_TASK is not None and not GROUP_TASK.done():
+        return "Викторина в группе уже идёт."
+    STORE.set_meta(GROUP_STOP_KEY, None)
+    GROUP_TASK = spawn(_run_group_quiz_safe(ctx, chat_id, admin_chat))
+    return f"👥 Запускаю викторину в группе {chat_id}: {len(paper_for(BANK, chat_id))} вопросов."
 
 # ---------- ОТЧЁТ ДЛЯ АДМИНА ----------
-async def export_results_file() -> str:
-    wb = openpyxl.Workbook()
-    ws = wb.active
-    ws.title = "Answers"
-    ws.append(["Страна","Пользователь","Вопрос №","Ответ(ы) индексы","Правильно"])
-
-    answers: List[Tuple[int,int,str,int]] = []
-    user_country: Dict[int,str] = {}
-    with db() as conn:
-        for uid,cnt in conn.execute("SELECT user_id,country FROM users"):
-            user_country[uid] = cnt or "?"
-        for row in conn.execute("SELECT user_id,q_index,option_ids,correct FROM answers"):
-            answers.append(row)
-
-    for uid,qidx,opt,corr in answers:
-        ws.append([user_country.get(uid,"?"), uid, qidx+1, opt, "Да" if corr else "Нет"])
-    for col in ws.columns:
-        ws.column_dimensions[get_column_letter(col[0].column)].width = 18
-
-    ws2 = wb.create_sheet("ByCountry")
-    ws2.append(["Страна","Участников","Ответов всего","Правильных","Неправильных","Точность, %"])
-    stats: Dict[str, Dict[str,int]] = {}
-    users: Dict[str, Set[int]] = {}
-    for uid,qidx,opt,corr in answers:
-        c = user_country.get(uid,"?")
-        stats.setdefault(c, {"tot":0,"ok":0})
-        users.setdefault(c,set()).add(uid)
-        stats[c]["tot"] += 1
-        if corr: stats[c]["ok"] += 1
-    for c,s in stats.items():
-        tot=s["tot"]; ok=s["ok"]; bad=tot-ok; ppl=len(users.get(c,set()))
-        acc=round((ok/tot*100) if tot else 0.0,2)
-        ws2.append([c,ppl,tot,ok,bad,acc])
-    for col in ws2.columns:
-        ws2.column_dimensions[get_column_letter(col[0].column)].width = 18
-
-    ws3 = wb.create_sheet("ByCountryQuestion")
-    ws3.append(["Страна","Вопрос №","Ответов","Правильных","Неправильных","Точность, %"])
-    cqm: Dict[Tuple[str,int],Dict[str,int]] = {}
-    for uid,qidx,opt,corr in answers:
-        c=user_country.get(uid,"?")
-        key=(c,qidx+1)
-        d=cqm.setdefault(key,{"tot":0,"ok":0})
-        d["tot"]+=1
-        if corr: d["ok"]+=1
-    for (c,qn),d in sorted(cqm.items(), key=lambda x:(x[0][0],x[0][1])):
-        tot=d["tot"]; ok=d["ok"]; bad=tot-ok; acc=round((ok/tot*100) if tot else 0.0,2)
-        ws3.append([c,qn,tot,ok,bad,acc])
-    for col in ws3.columns:
-        ws3.column_dimensions[get_column_letter(col[0].column)].width = 18
-
-    path = f"results_%d.xlsx" % int(time.time())
-    wb.save(path)
+REPORT_COL_WIDTH = 18
+
+def _summary_row(head: list, tot: int, ok: int) -> list:
+    ok = ok or 0
+    acc = round((ok / tot * 100) if tot else 0.0, 2)
+    return head + [tot, ok, tot - ok, acc]
+
+def build_results_file(path: str, round_id: int) -> str:
+    """Собирает Excel-отчёт по раунду. Вызывается в отдельном потоке со своим соединением:
+    сводки — из агрегатов, лист ответов пишется потоково (write-only).
+    У архивного раунда лист ответов пуст — остаются только сводки."""
+    import openpyxl
+    from openpyxl.utils import get_column_letter
+    store = Storage(DB_FILE).open(init_schema=False)
+    try:
+        wb = openpyxl.Workbook(write_only=True)
+
+        ws = wb.create_sheet("Answers")
+        for i in range(1, 6):
+            ws.column_dimensions[get_column_letter(i)].width = REPORT_COL_WIDTH
+        ws.append(["Страна","Пользователь","Вопрос №","Ответ(ы) индексы","Правильно"])
+        for country, uid, qidx, mask, corr in store.iter_answers(round_id):
+            ws.append([country, uid, qidx+1, json.dumps(mask_options(mask)), "Да" if corr else "Нет"])
+
+        ws2 = wb.create_sheet("ByCountry")
+        for i in range(1, 7):
+            ws2.column_dimensions[get_column_letter(i)].width = REPORT_COL_WIDTH
+        ws2.append(["Страна","Участников","Ответов всего","Правильных","Неправильных","Точность, %"])
+        for country, ppl, tot, ok in store.country_summary(round_id):
+            ws2.append(_summary_row([country, ppl], tot, ok))
+
+        ws3 = wb.create_sheet("ByCountryQuestion")
+        for i in range(1, 7):
+            ws3.column_dimensions[get_column_letter(i)].width = REPORT_COL_WIDTH
+        ws3.append(["Страна","Вопрос №","Ответов","Правильных","Неправильных","Точность, %"])
+        for country, qidx, tot, ok in store.country_question_summary(round_id):
+            ws3.append(_summary_row([country, qidx+1], tot, ok))
+
+        wb.save(path)
+    finally:
+        store.close()
+    return path
+
+async def export_results_file(round_id: Optional[int] = None) -> str:
+    await WRITER.flush()
+    round_id = ROUND_ID if round_id is None else round_id
+    await asyncio.to_thread(cleanup_exports)
+    os.makedirs(EXPORT_DIR, exist_ok=True)
+    path = os.path.join(EXPORT_DIR, f"results_r{round_id}_{int(time.time())}.xlsx")
+    t0 = time.monotonic()
+    await asyncio.to_thread(build_results_file, path, round_id)
+    REPORT_SECONDS.observe(time.monotonic() - t0)
+    log.info("Report %s built in %.2fs", path, time.monotonic() - t0)
     return path
 
+async def send_report(ctx: ContextTypes.DEFAULT_TYPE, chat_id: int, round_id: Optional[int] = None):
+    """Отчёт админу (по умолчанию — текущий раунд). Ключ кэша — раунд и версия данных:
+    если с прошлого отчёта ничего не записано, файл не собирается и не загружается
+    повторно, уходит сохранённый file_id."""
+    await WRITER.flush()
+    round_id = ROUND_ID if round_id is None else round_id
+    prefix = f"report:{round_id}:"
+    key = f"{prefix}{STORE.data_version()}"
+
+    async def build():
+        return Path(await export_results_file(round_id))
+
+    msg = await send_cached_media(ctx.bot, chat_id, "document", key, build)
+    for stale in MEDIA.keys(prefix):
+        if stale != key:
+            MEDIA.invalidate(stale)
+    return msg
+
+# ---------- ПОТОКОВАЯ ВЫГРУЗКА ----------
+# Для больших раундов вместо Excel: строки из курсора SQLite сразу в gzip CSV/JSONL,
+# память не растёт с числом ответов. Режим «новое» — ответы с seq больше отметки
+# прошлой выгрузки раунда (meta export_seq:<раунд>, общая для шардов).
+EXPORT_MARK_KEY = "export_seq:{}"
+
+def cleanup_exports() -> int:
+    age = EXPORT_KEEP_HOURS * 3600
+    removed = export.cleanup(EXPORT_DIR, age, ("results_", "answers_"))
+    removed += export.cleanup(".", age, ("results_",), ".xlsx")   # отчёты прежних версий — рядом с кодом
+    if removed:
+        log.info("Removed %d old export files", removed)
+    return removed
+
+def build_export_file(round_id: int, fmt: str, since: Optional[int]) -> Tuple[List[str], int, int]:
+    """Выгрузка в отдельном потоке со своим соединением. Возвращает (части, строк, seq-граница)."""
+    store = Storage(DB_FILE).open(init_schema=False)
+    try:
+        until = store.last_answer_seq()
+        kind = "new" if since is not None else "all"
+        # граница seq в имени: выгрузки в одну секунду не перезаписывают друг друга
+        stem = f"answers_r{round_id}_{kind}_{int(time.time())}_{until}"
+        rows = store.iter_export(round_id, until, since, EXPORT_CHUNK)
+        paths, count, _ = export.write_export(rows, EXPORT_DIR, stem, fmt, EXPORT_PART_MB * 1024 * 1024)
+    finally:
+        store.close()
+    return paths, count, until
+
+async def send_export(ctx: ContextTypes.DEFAULT_TYPE, chat_id: int, round_id: Optional[int] = None,
+                      fmt: str = "csv", since_last: bool = False) -> str:
+    """Выгрузка раунда документами по частям. Отметка «новое» сдвигается, только когда
+    ушли все части: сорвавшаяся выгрузка повторится с того же места. Возвращает ответ админу."""
+    await WRITER.flush()
+    round_id = ROUND_ID if round_id is None else round_id
+    mark_key = EXPORT_MARK_KEY.format(round_id)
+    since = None
+    if since_last:
+        mark = STORE.get_meta(mark_key)
+        since = int(mark) if mark else -1   # -1: ответы до появления seq (seq=0) тоже новые
+    await asyncio.to_thread(cleanup_exports)
+    t0 = time.monotonic()
+    paths, count, until = await asyncio.to_thread(build_export_file, round_id, fmt, since)
+    EXPORT_SECONDS.observe(time.monotonic() - t0)
+    log.info("Export of round %d (%s, %s): %d rows in %d parts, %.2fs",
+             round_id, fmt, "new" if since_last else "all", count, len(paths), time.monotonic() - t0)
+    for i, path in enumerate(paths, start=1):
+        caption = f"Раунд {round_id}, часть {i}/{len(paths)}" if len(paths) > 1 else f"Раунд {round_id}"
+        await ctx.bot.send_document(chat_id, Path(path), caption=caption,
+                                    write_timeout=EXPORT_UPLOAD_TIMEOUT)
+    if since_last:
+        STORE.set_meta(mark_key, str(until))
+    scope = "новые с прошлой выгрузки" if since_last else "все"
+    if not paths:
+        return f"📦 Раунд {round_id}: ответов нет ({scope})."
+    return f"📦 Раунд {round_id}, {fmt}.gz: {count} ответов ({scope}), частей: {len(paths)}."
+
+# ---------- ФОНОВЫЕ ЗАДАЧИ ----------
+# Долгие задачи (рассылка старта, викторина в группе, управляющие сообщения шардов,
+# профилирование) живут вне Application: app.stop() дожидается каждой своей create_task,
+# и SIGTERM посреди них держал бы остановку минутами (платформа добивает процесс до
+# сброса записи ответов). running() отменяет их до app.stop().
+BACKGROUND: Set[asyncio.Task] = set()
+
+def spawn(coro) -> asyncio.Task:
+    task = asyncio.get_running_loop().create_task(coro)
+    BACKGROUND.add(task)
+    task.add_done_callback(BACKGROUND.discard)
+    return task
+
+async def cancel_background():
+    tasks = list(BACKGROUND)
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+
+# ---------- ПРОФИЛИРОВАНИЕ ----------
+PROFILE_TASK: Optional[asyncio.Task] = None
+
+async def _profile_and_send(ctx: ContextTypes.DEFAULT_TYPE, chat_id: int, seconds: int):
+    import profiling
+    try:
+        report = await profiling.profile(seconds)
+        name = f"profile_{int(time.time())}.txt" if SHARDS == 1 else f"profile_s{SHARD}_{int(time.time())}.txt"
+        await ctx.bot.send_document(chat_id, report.encode("utf-8"), filename=name)
+    except Exception as e:
+        log.exception("Profiling failed")
+        await ctx.bot.send_message(chat_id, f"Профилирование не удалось: {e}")
+
+def start_profiling(ctx: ContextTypes.DEFAULT_TYPE, chat_id: int, seconds: int) -> str:
+    """Запускает профиль в фоне (обработка апдейтов админа не ждёт). Возвращает ответ админу."""
+    global PROFILE_TASK
+    if PROFILE_TASK is not None and not PROFILE_TASK.done():
+        return "Профилирование уже идёт."
+    seconds = max(1, min(seconds, PROFILE_MAX_SECONDS))
+    PROFILE_TASK = spawn(_profile_and_send(ctx, chat_id, seconds))
+    return f"🔬 {shard_label()}Профилирую {seconds} с, пришлю отчёт документом."
+
+async def status_text() -> str:
+    await WRITER.flush()
+    rows = STORE.country_counts(ROUND_ID)
+    total = sum(r[1] for r in rows)
+    lines = [f"{shard_label()}Раунд {ROUND_ID}. Всего зарегистрировано: {total}"]
+    for c, cnt in rows:
+        lines.append(f"- {c}: {cnt}")
+    chat_id = group_chat()
+    lines.append(f"Группа: {chat_id if chat_id is not None else 'не привязана'}")
+    stopped = STORE.get_meta(GROUP_STOP_KEY)
+    if stopped and int(stopped.split(":")[0]) == ROUND_ID:
+        _, published, total_q = stopped.split(":")
+        lines.append(f"⚠️ Викторина в группе прервана остановкой бота: опубликовано {published} из {total_q} "
+                     f"вопросов, сводки не разосланы")
+    paper = paper_for(BANK, 0)
+    lines.append(f"Банк {BANK.version}: {len(BANK)} вопросов, в билете {len(paper)}"
+                 + (", варианты перемешиваются" if SHUFFLE_OPTIONS else ""))
+    lines.append(f"Попыток в памяти: {len(STATE)}")
+    lines.append(f"Активных таймеров вопросов: {TIMERS.pending}")
+    lines.append(UPDATE_STATS.text())
+    lines.append(OUTBOX.text())
+    return "\n".join(lines)
+
 # ---------- КНОПКИ ДЛЯ АДМИНА ----------
 def admin_keyboard() -> InlineKeyboardMarkup:
     return InlineKeyboardMarkup([
-        [InlineKeyboardButton("▶️ Старт викторины", callback_data="admin:start")],
+        [
+            InlineKeyboardButton("▶️ Старт викторины", callback_data="admin:start"),
+            InlineKeyboardButton("👥 Старт в группе",  callback_data="admin:group_start"),
+        ],
         [
             InlineKeyboardButton("📄 Отчёт (Excel)", callback_data="admin:report"),
+            InlineKeyboardButton("📦 Новое (CSV)",   callback_data="admin:export"),
             InlineKeyboardButton("📊 Статус",        callback_data="admin:status"),
         ],
         [
             InlineKeyboardButton("🔄 Перечитать вопросы", callback_data="admin:reload"),
+            InlineKeyboardButton(f"🔬 Профиль {PROFILE_SECONDS} с", callback_data="admin:profile"),
         ],
         [
             InlineKeyboardButton("🗑 Сбросить всё", callback_data="admin:reset"),
@@ -369,48 +1824,43 @@ async def on_admin_button(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     data = cq.data or ""
     if data == "admin:start":
         # Старт как /start_quiz
-        try:
-            msg = await cq.edit_message_text("▶️ Запускаю…")
-        except:
-            msg = await cq.message.reply_text("▶️ Запускаю…")
-        # выполняем запуск
-        started = 0
-        if not QUESTIONS:
+        if not BANK:
             await cq.message.reply_text("Нет загруженных вопросов. Используй /reload или /setq.")
             return
-        uids = get_registered_users()
-        await cq.message.reply_text(f"Старт для {len(uids)} пользователей.")
-        for u in uids:
-            s = st(u)
-            if not s.started or s.finished:
-                try:
-                    await ctx.bot.send_message(u, "Организатор запустил викторину.")
-                    await start_user_quiz(u, ctx, COUNTDOWN)
-                    started += 1
-                except Exception as e:
-                    log.warning("Cannot start for %s: %s", u, e)
-        await cq.message.reply_text(f"Готово. Запущено: {started}/{len(uids)}.")
-        # Вернём панель
-        await cq.message.reply_text("Панель:", reply_markup=admin_keyboard())
+        n = await launch_round(ctx, uid)
+        if n is None:
+            await cq.answer("Старт уже выполняется.")
+            return
+        try:
+            await cq.edit_message_text(f"▶️ Запускаю для {n} пользователей…")
+        except:
+            await cq.message.reply_text(f"▶️ Запускаю для {n} пользователей…")
+
+    elif data == "admin:group_start":
+        await cq.answer()
+        await cq.message.reply_text(launch_group_round(ctx, uid))
 
     elif data == "admin:report":
         await cq.answer("Формирую отчёт…")
-        path = await export_results_file()
-        await ctx.bot.send_document(uid, open(path, "rb"), filename=os.path.basename(path))
+        await send_report(ctx, uid)
         await cq.message.reply_text("Панель:", reply_markup=admin_keyboard())
 
+    elif data == "admin:export":
+        await cq.answer("Выгружаю новые ответы…")
+        text = await send_export(ctx, uid, since_last=True)
+        await cq.message.reply_text(text, reply_markup=admin_keyboard())
+
     elif data == "admin:status":
-        with db() as conn:
-            rows = conn.execute("SELECT country, COUNT(*) FROM users WHERE country IS NOT NULL GROUP BY country").fetchall()
-        total = sum(r[1] for r in rows)
-        lines = [f"Всего зарегистрировано: {total}"]
-        for c, cnt in rows:
-            lines.append(f"- {c}: {cnt}")
-        await cq.message.reply_text("\n".join(lines), reply_markup=admin_keyboard())
+        await cq.message.reply_text(await status_text(), reply_markup=admin_keyboard())
+
+    elif data == "admin:profile":
+        await cq.answer()
+        await cq.message.reply_text(start_profiling(ctx, uid, PROFILE_SECONDS))
 
     elif data == "admin:reload":
-        n = load_questions_from_file()
-        await cq.message.reply_text(f"Перечитал {QUESTIONS_FILE}: вопросов {n}.", reply_markup=admin_keyboard())
+        n = await reload_questions()
+        await cq.message.reply_text(f"Перечитал {QUESTIONS_FILE}: вопросов {n} ({BANK.version}).",
+                                    reply_markup=admin_keyboard())
 
     elif data == "admin:reset":
         # Подтверждение
@@ -420,11 +1870,17 @@ async def on_admin_button(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
                 InlineKeyboardButton("❌ Отмена",            callback_data="admin:reset_cancel"),
             ]
         ])
-        await cq.message.reply_text("Вы уверены, что хотите полностью очистить регистрации и ответы?", reply_markup=kb)
+        await cq.message.reply_text("Начать новый раунд? Регистрации и ответы начнутся с нуля, прошлый раунд останется в отчётах.", reply_markup=kb)
 
     elif data == "admin:reset_confirm":
-        reset_all()
-        await cq.message.reply_text("✅ Всё очищено. Участникам нужно снова выбрать страну в /start.", reply_markup=admin_keyboard())
+        previous = ROUND_ID
+        round_id, stopped = await reset_all()
+        await cq.message.reply_text(
+            f"✅ Открыт раунд {round_id}. Участникам нужно снова выбрать страну в /start.\n"
+            + ("Идущий старт / викторина в группе остановлены.\n" if stopped else "")
+            + f"Отчёт по прошлому раунду: /report {previous}",
+            reply_markup=admin_keyboard()
+        )
 
     elif data == "admin:reset_cancel":
         await cq.message.reply_text("Отменено.", reply_markup=admin_keyboard())
@@ -460,10 +1916,14 @@ async def cmd_help(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         "Админ:\n"
         "/admin — панель управления кнопками\n"
         "/start_quiz — запустить викторину для всех зарегистрированных\n"
-        "/report — Excel-отчёт\n"
+        "/bind — (в группе) привязать группу, /unbind — отвязать\n"
+        "/group_start — викторина в привязанной группе: один общий опрос на вопрос\n"
+        "/report [раунд] — Excel-отчёт (по умолчанию текущий раунд)\n"
+        "/export [csv|jsonl] [new] [раунд] — выгрузка ответов в gzip (new — только новое с прошлой)\n"
         "/reload — перечитать questions.json\n"
         "/setq <raw_json_url> — загрузить вопросы по URL\n"
-        "/status — зарегистрированные пользователи по странам"
+        "/status — зарегистрированные пользователи по странам\n"
+        "/profile [сек] — профиль CPU и памяти работающего бота (документом)"
     )
 
 # ---------- КОМАНДЫ (админ — текстовые, оставлены как альтернатива кнопкам) ----------
@@ -475,35 +1935,79 @@ async def cmd_admin(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 async def cmd_start_quiz(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.effective_user.id):
         return
-    if not QUESTIONS:
+    if not BANK:
         await update.message.reply_text("Нет загруженных вопросов. Используй /reload или /setq.")
         return
-    uids = get_registered_users()
-    await update.message.reply_text(f"▶️ Запускаю викторину для {len(uids)} зарегистрированных пользователей.")
-    started = 0
-    for uid in uids:
-        s = st(uid)
-        if not s.started or s.finished:
-            try:
-                await update.get_bot().send_message(uid, "Организатор запустил викторину.")
-                await start_user_quiz(uid, ctx, COUNTDOWN)
-                started += 1
-            except Exception as e:
-                log.warning("Cannot start for %s: %s", uid, e)
-    await update.message.reply_text(f"Готово. Запущено попыток: {started}/{len(uids)}.")
+    n = await launch_round(ctx, update.effective_user.id)
+    if n is None:
+        await update.message.reply_text("Старт уже выполняется, дождитесь завершения.")
+        return
+    await update.message.reply_text(f"▶️ Запускаю викторину для {n} зарегистрированных пользователей.")
+
+async def cmd_bind(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id):
+        return
+    chat = update.effective_chat
+    if chat.type not in ("group", "supergroup"):
+        # в каналах неанонимные опросы запрещены Telegram — голоса по пользователям не получить
+        await update.message.reply_text("Отправьте /bind в группе, куда добавлен бот.")
+        return
+    STORE.set_meta(GROUP_META_KEY, str(chat.id))
+    await update.message.reply_text(
+        f"👥 Группа привязана ({chat.id}). Старт — кнопкой «Старт в группе» в /admin или /group_start."
+    )
+
+async def cmd_unbind(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id):
+        return
+    STORE.set_meta(GROUP_META_KEY, None)
+    await update.message.reply_text("Группа отвязана.")
+
+async def cmd_group_start(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id):
+        return
+    await update.message.reply_text(launch_group_round(ctx, update.effective_user.id))
 
 async def cmd_report(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.effective_user.id):
         return
-    await update.message.reply_text("Формирую отчёт…")
-    path = await export_results_file()
-    await ctx.bot.send_document(update.effective_user.id, open(path, "rb"), filename=os.path.basename(path))
+    try:
+        round_id = int(ctx.args[0]) if ctx.args else ROUND_ID
+    except ValueError:
+        await update.message.reply_text("Использование: /report [номер раунда]")
+        return
+    if round_id not in {rid for rid, _, _ in STORE.rounds()}:
+        await update.message.reply_text(f"Раунда {round_id} нет. Текущий — {ROUND_ID}.")
+        return
+    await update.message.reply_text(f"Формирую отчёт по раунду {round_id}…")
+    await send_report(ctx, update.effective_user.id, round_id)
+
+async def cmd_export(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id):
+        return
+    fmt, since_last, round_id = "csv", False, ROUND_ID
+    for arg in ctx.args or []:
+        arg = arg.lower()
+        if arg in export.FORMATS:
+            fmt = arg
+        elif arg == "new":
+            since_last = True
+        elif arg.isdigit():
+            round_id = int(arg)
+        else:
+            await update.message.reply_text("Использование: /export [csv|jsonl] [new] [номер раунда]")
+            return
+    if round_id not in {rid for rid, _, _ in STORE.rounds()}:
+        await update.message.reply_text(f"Раунда {round_id} нет. Текущий — {ROUND_ID}.")
+        return
+    await update.message.reply_text(f"Выгружаю ответы раунда {round_id}…")
+    await update.message.reply_text(await send_export(ctx, update.effective_user.id, round_id, fmt, since_last))
 
 async def cmd_reload(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.effective_user.id):
         return
-    n = load_questions_from_file()
-    await update.message.reply_text(f"Перечитал {QUESTIONS_FILE}: вопросов {n}.")
+    n = await reload_questions()
+    await update.message.reply_text(f"Перечитал {QUESTIONS_FILE}: вопросов {n} ({BANK.version}).")
 
 async def cmd_setq(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.effective_user.id):
@@ -513,21 +2017,31 @@ async def cmd_setq(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
         return
     url = ctx.args[0]
     try:
-        n = await set_questions_from_url(url)
-        await update.message.reply_text(f"Загрузил новые вопросы. Всего: {n}.")
+        n, changed = await set_questions_from_url(url)
+        if changed:
+            await update.message.reply_text(
+                f"Загрузил новые вопросы ({BANK.version}). Всего: {n}.\n"
+                f"Начатые попытки доигрываются на прежней версии."
+            )
+        else:
+            await update.message.reply_text(f"Вопросы не изменились ({BANK.version}). Всего: {n}.")
     except Exception as e:
         await update.message.reply_text(f"Ошибка: {e}")
 
 async def cmd_status(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if not is_admin(update.effective_user.id):
         return
-    with db() as conn:
-        rows = conn.execute("SELECT country, COUNT(*) FROM users WHERE country IS NOT NULL GROUP BY country").fetchall()
-    total = sum(r[1] for r in rows)
-    lines = [f"Всего зарегистрировано: {total}"]
-    for c, cnt in rows:
-        lines.append(f"- {c}: {cnt}")
-    await update.message.reply_text("\n".join(lines))
+    await update.message.reply_text(await status_text())
+
+async def cmd_profile(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
+    if not is_admin(update.effective_user.id):
+        return
+    try:
+        seconds = int(ctx.args[0]) if ctx.args else PROFILE_SECONDS
+    except ValueError:
+        await update.message.reply_text("Использование: /profile [секунд]")
+        return
+    await update.message.reply_text(start_profiling(ctx, update.effective_user.id, seconds))
 
 # ---------- КНОПКИ (участник) ----------
 async def on_button(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
@@ -537,12 +2051,7 @@ async def on_button(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     if data.startswith("set_country:"):
         country = data.split(":",1)[1]
         uid = cq.from_user.id
-        with db() as conn:
-            conn.execute(
-                "INSERT INTO users(user_id,country) VALUES(?,?) "
-                "ON CONFLICT(user_id) DO UPDATE SET country=excluded.country",
-                (uid, country)
-            )
+        WRITER.register_user(ROUND_ID, uid, country)
         msg = (
             f"Страна: {country} сохранена.\n"
             f"Ожидайте старт от организатора. Время на каждый вопрос — {QUESTION_SECONDS} сек.\n"
@@ -556,68 +2065,424 @@ async def on_button(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
 # ---------- POLL (ответ участника) ----------
 async def on_poll_answer(update: Update, ctx: ContextTypes.DEFAULT_TYPE):
     ans = update.poll_answer
+    if ans.user is None:
+        # анонимный админ группы голосует от имени чата (voter_chat): ни попытки, ни сводки
+        return
     uid = ans.user.id
-    s = st(uid)
-    if s.finished or s.last_poll_id != ans.poll_id:
+    if GROUP_POLLS and record_group_answer(uid, ans.poll_id, ans.option_ids):
+        return
+    s = STATE.get(uid)
+    if s is None or s.finished or not s.is_current(ans.poll_id):
         return
+    TIMERS.cancel((uid, ans.poll_id))
 
-    q = QUESTIONS[s.index]
-    chosen = ans.option_ids or []
-    correct = int(set(chosen) == set(q.correct))
+    paper, pos = paper_for(s.bank, uid), s.index
+    q = paper.question(pos)
+    chosen = paper.to_original(pos, ans.option_ids or [])   # показанные варианты → номера в банке
+    mask = options_mask(chosen)
+    correct = int(mask == q.mask)
 
-    with db() as conn:
-        conn.execute(
-            "INSERT INTO answers(user_id,q_index,option_ids,correct) VALUES(?,?,?,?)",
-            (uid, s.index, json.dumps(chosen, ensure_ascii=False), correct)
-        )
+    WRITER.record_answer(ROUND_ID, uid, paper.items[pos], mask, bool(correct), s.bank.bank_id)
 
-    # Мгновенная обратная связь
-    def fmt(indices: List[int]) -> str:
-        return _fmt_opts(indices, q.options)
+    # Мгновенная обратная связь (в режиме склейки — в заголовке следующего вопроса)
     if correct:
-        fb = f"✅ Верно!\nВаш ответ: {fmt(chosen)}"
+        fb = f"✅ Верно!\nВаш ответ: {paper.fmt(pos, chosen)}"
+        short = "✅ Верно!"
     else:
-        fb = "❌ Неверно.\n" + f"Ваш ответ: {fmt(chosen)}\n" + f"Правильные варианты: {fmt(q.correct)}"
-    try:
-        await ctx.bot.send_message(uid, fb)
-    except Exception as e:
-        log.warning("Feedback send failed: %s", e)
+        correct_text = paper.correct_text(pos)
+        fb = "❌ Неверно.\n" + f"Ваш ответ: {paper.fmt(pos, chosen)}\n" + f"Правильные варианты: {correct_text}"
+        short = f"❌ Неверно. Правильно: {correct_text}"
 
     s.index += 1
-    await send_next(uid, ctx)
+    await send_next(uid, ctx, note=fb, short_note=short)
+
+# ---------- ОБРАБОТКА АПДЕЙТОВ ----------
+class KeyedLock:
+    """asyncio.Lock на ключ; замки создаются по требованию и удаляются, когда не нужны."""
+
+    def __init__(self):
+        self._locks: Dict[int, list] = {}   # key -> [lock, пользователей]
+
+    def __call__(self, key: int) -> "_KeyedLockCtx":
+        return _KeyedLockCtx(self, key)
+
+    def __len__(self) -> int:
+        return len(self._locks)
+
+class _KeyedLockCtx:
+    __slots__ = ("owner", "key", "entry")
+
+    def __init__(self, owner: KeyedLock, key: int):
+        self.owner = owner
+        self.key = key
+
+    async def __aenter__(self):
+        entry = self.owner._locks.get(self.key)
+        if entry is None:
+            entry = self.owner._locks[self.key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        self.entry = entry
+        try:
+            await entry[0].acquire()
+        except BaseException:
+            self._release_ref()
+            raise
+
+    async def __aexit__(self, *exc):
+        self.entry[0].release()
+        self._release_ref()
+
+    def _release_ref(self):
+        self.entry[1] -= 1
+        if self.entry[1] == 0:
+            self.owner._locks.pop(self.key, None)
+
+USER_LOCKS = KeyedLock()
+
+@dataclass
+class UpdateStats:
+    processed: int = 0
+    in_flight: int = 0
+    wait_total: float = 0.0
+    wait_max: float = 0.0
+
+    def text(self) -> str:
+        avg = (self.wait_total / self.processed * 1000) if self.processed else 0.0
+        return (f"Апдейты: обработано {self.processed}, в работе {self.in_flight}, "
+                f"ожидание в очереди ср. {avg:.0f} мс / макс. {self.wait_max * 1000:.0f} мс")
+
+UPDATE_STATS = UpdateStats()
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Апдейты разных пользователей обрабатываются параллельно (до `limit` одновременно),
+    апдейты одного пользователя — строго в порядке поступления (USER_LOCKS)."""
+
+    def __init__(self, limit: int, backlog: int):
+        super().__init__(max_concurrent_updates=max(backlog, limit))
+        self._slots = asyncio.Semaphore(limit)
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        t0 = time.monotonic()
+        user = update.effective_user if isinstance(update, Update) else None
+        UPDATE_STATS.in_flight += 1
+        try:
+            if user is None:
+                async with self._slots:
+                    self._record_wait(t0)
+                    await coroutine
+            else:
+                # сначала очередь пользователя, потом слот — ждущие своей очереди слоты не занимают
+                async with USER_LOCKS(user.id):
+                    async with self._slots:
+                        self._record_wait(t0)
+                        await coroutine
+        finally:
+            UPDATE_STATS.in_flight -= 1
+
+    @staticmethod
+    def _record_wait(t0: float):
+        wait = time.monotonic() - t0
+        UPDATE_STATS.processed += 1
+        UPDATE_STATS.wait_total += wait
+        UPDATE_STATS.wait_max = max(UPDATE_STATS.wait_max, wait)
+        if wait > 1.0:
+            log.info("Update waited %.2fs in queue", wait)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
 
 # ---------- APP ----------
+async def on_startup(app: Application):
+    # тёплый рестарт: попытки из журнала, таймеры открытых опросов — на оставшееся время
+    ctx = ContextTypes.DEFAULT_TYPE(app)
+    now = time.time()
+    for uid, poll_id, deadline in restore_state():
+        TIMERS.schedule((uid, poll_id), max(0.0, deadline - now), ctx)
+    STARTUP.mark("restore")
+    OUTBOX.start()
+    TIMERS.start(on_question_timeouts)
+    if SHARD == 0:   # архивация и чистка выгрузок — одни на все шарды
+        schedule_archive()
+        await asyncio.to_thread(cleanup_exports)
+
+async def on_stop(app: Application):
+    # бот ещё жив: даём исходящей очереди дойти до конца
+    await TIMERS.stop()
+    await OUTBOX.stop()
+    if ARCHIVE_TASK is not None and not ARCHIVE_TASK.done():
+        ARCHIVE_TASK.cancel()   # недочищенный раунд догонится при следующем старте
+        await asyncio.gather(ARCHIVE_TASK, return_exceptions=True)
+
+async def on_shutdown(app: Application):
+    if HTTP is not None:
+        await HTTP.aclose()
+    WRITER.close()   # дописываем очередь до закрытия
+    STORE.close()
+
 def build_app() -> Application:
+    """Приложение без Updater: апдейты кладёт в очередь наш вебхук (или фронт-процесс шардов).
+    Жизненный цикл (on_startup/on_stop/on_shutdown) ведёт running()."""
+    global ROUND_ID
+    STORE.open()
+    ROUND_ID = STORE.current_round()
+    MEDIA.load()
+    WRITER.start()
+    STARTUP.mark("db")
     load_questions_from_file()
-    app = ApplicationBuilder().token(BOT_TOKEN).build()
+    STARTUP.mark("questions")
+    request = MeteredRequest(connection_pool_size=256)
+    builder = (
+        ApplicationBuilder()
+        .token(BOT_TOKEN)
+        .base_url(f"{BOT_API_URL}/bot")
+        .base_file_url(f"{BOT_API_URL}/file/bot")
+        .request(request)
+        .get_updates_request(request)   # getUpdates не вызываем (вебхук): второй httpx-клиент с TLS не нужен
+        .concurrent_updates(PerUserUpdateProcessor(UPDATE_CONCURRENCY, UPDATE_BACKLOG))
+        .updater(None)
+    )
+    app = builder.build()
 
     # Участник
-    app.add_handler(CommandHandler("start",  cmd_start))
-    app.add_handler(CommandHandler("again",  cmd_again))
-    app.add_handler(CommandHandler("help",   cmd_help))
+    app.add_handler(CommandHandler("start",  metered(cmd_start)))
+    app.add_handler(CommandHandler("again",  metered(cmd_again)))
+    app.add_handler(CommandHandler("help",   metered(cmd_help)))
 
     # Админ (кнопочная панель + текстовые команды)
-    app.add_handler(CommandHandler("admin",      cmd_admin))
-    app.add_handler(CallbackQueryHandler(on_admin_button, pattern=r"^admin:"))
-    app.add_handler(CommandHandler("start_quiz", cmd_start_quiz))
-    app.add_handler(CommandHandler("report",     cmd_report))
-    app.add_handler(CommandHandler("reload",     cmd_reload))
-    app.add_handler(CommandHandler("setq",       cmd_setq))
-    app.add_handler(CommandHandler("status",     cmd_status))
+    app.add_handler(CommandHandler("admin",      metered(cmd_admin)))
+    app.add_handler(CallbackQueryHandler(metered(on_admin_button), pattern=r"^admin:"))
+    app.add_handler(CommandHandler("start_quiz", metered(cmd_start_quiz)))
+    app.add_handler(CommandHandler("bind",       metered(cmd_bind)))
+    app.add_handler(CommandHandler("unbind",     metered(cmd_unbind)))
+    app.add_handler(CommandHandler("group_start", metered(cmd_group_start)))
+    app.add_handler(CommandHandler("report",     metered(cmd_report)))
+    app.add_handler(CommandHandler("export",     metered(cmd_export)))
+    app.add_handler(CommandHandler("reload",     metered(cmd_reload)))
+    app.add_handler(CommandHandler("setq",       metered(cmd_setq)))
+    app.add_handler(CommandHandler("status",     metered(cmd_status)))
+    app.add_handler(CommandHandler("profile",    metered(cmd_profile)))
 
     # Кнопки участника + ответы на опросы
-    app.add_handler(CallbackQueryHandler(on_button))
-    app.add_handler(PollAnswerHandler(on_poll_answer))
+    app.add_handler(CallbackQueryHandler(metered(on_button)))
+    app.add_handler(PollAnswerHandler(metered(on_poll_answer)))
+    STARTUP.mark("app")
     return app
 
-if __name__ == "__main__":
+# ---------- ВЕБХУК-СЕРВЕР ----------
+# Свой tornado-сервер вместо run_webhook: на том же порту отдаём /metrics.
+class _WebhookHandler(tornado.web.RequestHandler):
+    def initialize(self, route):
+        self.route = route
+
+    def post(self):
+        try:
+            data = json.loads(self.request.body)
+        except ValueError:
+            raise tornado.web.HTTPError(400)
+        self.route(data, self.request.body)
+
+class _MetricsHandler(tornado.web.RequestHandler):
+    def initialize(self, collect):
+        self.collect = collect
+
+    def get(self):
+        if METRICS_TOKEN:
+            auth = self.request.headers.get("Authorization", "")
+            if self.get_query_argument("token", "") != METRICS_TOKEN and auth != f"Bearer {METRICS_TOKEN}":
+                raise tornado.web.HTTPError(403)
+        self.set_header("Content-Type", metrics.CONTENT_TYPE)
+        self.write(self.collect())
+
+def webhook_server(route, collect_metrics):
+    """route(data, raw) — приём апдейта; collect_metrics() — текст для /metrics."""
+    logging.getLogger("tornado.access").setLevel(logging.WARNING)   # строка лога на каждый апдейт — лишнее
+    return tornado.web.Application([
+        (rf"/{re.escape(BOT_TOKEN)}/?", _WebhookHandler, {"route": route}),
+        (r"/metrics", _MetricsHandler, {"collect": collect_metrics}),
+    ]).listen(PORT, "0.0.0.0")
+
+async def set_webhook(bot):
+    await bot.set_webhook(
+        f"{PUBLIC_URL}/{BOT_TOKEN}",                # скрытый путь, Telegram будет слать сюда
+        allowed_updates=ALLOWED_UPDATES,
+        drop_pending_updates=DROP_PENDING_UPDATES,  # ответы, пришедшие во время рестарта, не теряем
+    )
+
+def stop_event() -> asyncio.Event:
+    """Событие, которое взводят SIGINT/SIGTERM."""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    return stop
+
+@asynccontextmanager
+async def running(app: Application):
+    """Жизненный цикл приложения без Updater (порядок как в run_webhook)."""
+    await app.initialize()
+    STARTUP.mark("initialize")
+    await on_startup(app)
+    await app.start()
+    try:
+        yield app
+    finally:
+        await cancel_background()
+        await app.stop()
+        await on_stop(app)
+        await app.shutdown()
+        await on_shutdown(app)
+
+async def serve(app: Application):
+    stop = stop_event()
+    async with running(app):
+        # сначала слушаем порт: апдейт, разбудивший инстанс, не ждёт setWebhook
+        server = webhook_server(
+            lambda data, raw: app.update_queue.put_nowait(Update.de_json(data, app.bot)),
+            METRICS.render,
+        )
+        STARTUP.mark("listen")
+        await set_webhook(app.bot)
+        STARTUP.mark("set_webhook")
+        STARTUP.report()
+        await stop.wait()
+        server.stop()
+
+# ---------- ШАРДИРОВАНИЕ ----------
+# Фронт-процесс только принимает вебхук и кладёт сырое тело апдейта в очередь
+# воркера user_id % WORKERS. Воркер — обычный бот без Updater: свой event loop,
+# своя доля пользователей, таймеров и лимита рассылки. Метрики воркеры раз в
+# METRICS_PUSH_EVERY секунд отдают фронту снимком, /metrics фронта сливает их с меткой shard.
+FRONT_METRICS = metrics.Registry()
+FRONT_UPDATES = FRONT_METRICS.counter("quiz_webhook_updates_total", "Updates routed by the front", ["shard"])
+
+def _update_user_id(data: dict) -> int:
+    for key in ("message", "edited_message", "callback_query", "poll_answer"):
+        obj = data.get(key)
+        if obj:
+            user = obj.get("from") or obj.get("user") or {}
+            return int(user.get("id", 0))
+    return 0
+
+async def on_control(app: Application, op: str, args: tuple):
+    """Управляющее сообщение от шарда админа."""
+    ctx = ContextTypes.DEFAULT_TYPE(app)
+    global ROUND_ID
+    if op == "launch":
+        await launch_round(ctx, args[0], fan=False)
+    elif op == "reset":
+        await stop_round_tasks()
+        ROUND_ID = args[0]
+        reset_memory()
+    elif op == "bank":
+        activate_bank(await asyncio.to_thread(_bank_by_id, args[0], {}))
+    elif op == "group_poll":
+        poll_id, bank_id, chat_id, pos = args
+        paper = await group_paper(bank_id, chat_id)
+        if paper is not None:
+            add_group_poll(poll_id, paper, pos)
+    elif op == "group_done":
+        paper = await group_paper(*args)
+        if paper is not None:
+            await send_group_summaries(ctx, paper)
+    else:
+        log.warning("Unknown control op %r", op)
+
+def _dispatch(app: Application, item: tuple):
+    if item[0] == "update":
+        app.update_queue.put_nowait(Update.de_json(json.loads(item[1]), app.bot))
+    else:
+        _, op, args = item
+        spawn(on_control(app, op, args))
+
+async def _push_metrics(out):
+    labels = (("shard", str(SHARD)),)
+    while True:
+        out.put((SHARD, METRICS.collect(labels)))
+        await asyncio.sleep(METRICS_PUSH_EVERY)
+
+async def _serve_shard(app: Application, inbox, metrics_out):
+    loop = asyncio.get_running_loop()
+    stop = stop_event()
+
+    def pump():
+        # блокирующее чтение межпроцессной очереди — в своём потоке
+        while True:
+            item = inbox.get()
+            if item is None:
+                loop.call_soon_threadsafe(stop.set)
+                return
+            loop.call_soon_threadsafe(_dispatch, app, item)
+
+    async with running(app):
+        threading.Thread(target=pump, name=f"shard-{SHARD}-inbox", daemon=True).start()
+        pusher = asyncio.create_task(_push_metrics(metrics_out))
+        STARTUP.mark("ready")
+        log.info("Shard %d/%d ready", SHARD + 1, SHARDS)
+        STARTUP.report()
+        await stop.wait()
+        pusher.cancel()
+
+def _shard_main(shard: int, queues: list, metrics_out):
+    global SHARD, SHARDS, SHARD_QUEUES
+    SHARD, SHARDS, SHARD_QUEUES = shard, len(queues), queues
+    LIMITER.share(SHARDS)   # лимит Telegram — на бота целиком
+    asyncio.run(_serve_shard(build_app(), queues[shard], metrics_out))
+
+async def _serve_front(queues: list, metrics_in):
+    from telegram import Bot
+
+    snapshots: Dict[int, list] = {}
+
+    def pull_metrics():
+        while True:
+            item = metrics_in.get()
+            if item is None:
+                return
+            shard, families = item
+            snapshots[shard] = families
+
+    def route(data: dict, raw: bytes):
+        shard = _update_user_id(data) % len(queues)
+        FRONT_UPDATES.inc(shard)
+        queues[shard].put(("update", raw))
+
+    threading.Thread(target=pull_metrics, name="metrics-in", daemon=True).start()
+    stop = stop_event()
+    # порт — сразу: апдейты копятся в очередях, пока воркеры поднимаются
+    server = webhook_server(route, lambda: metrics.render([*snapshots.values(), FRONT_METRICS.collect()]))
+    STARTUP.mark("listen")
+    async with Bot(BOT_TOKEN, base_url=f"{BOT_API_URL}/bot") as bot:
+        await set_webhook(bot)
+    STARTUP.mark("set_webhook")
+    STARTUP.report()
+    await stop.wait()
+    server.stop()
+    metrics_in.put(None)
+
+def run_sharded(workers: int):
+    Storage(DB_FILE).open().close()   # схема и миграции — один раз, до старта воркеров
+    mp = multiprocessing.get_context("spawn")
+    queues = [mp.Queue() for _ in range(workers)]
+    metrics_q = mp.Queue()
+    procs = [mp.Process(target=_shard_main, args=(i, queues, metrics_q), name=f"shard-{i}")
+             for i in range(workers)]
+    for p in procs:
+        p.start()
+    try:
+        asyncio.run(_serve_front(queues, metrics_q))
+    finally:
+        for q in queues:
+            q.put(None)
+        for p in procs:
+            p.join(timeout=30)
+
+if __name__ == "__main__" and WORKERS > 1:
+    log.info("Starting %d webhook workers on port %s; PUBLIC_URL=%s", WORKERS, PORT, PUBLIC_URL)
+    run_sharded(WORKERS)
+elif __name__ == "__main__":
     application = build_app()
     log.info("Starting in WEBHOOK mode on port %s; PUBLIC_URL=%s", PORT, PUBLIC_URL)
-    application.run_webhook(
-        listen="0.0.0.0",
-        port=PORT,
-        url_path=BOT_TOKEN,                         # скрытый путь
-        webhook_url=f"{PUBLIC_URL}/{BOT_TOKEN}",    # Telegram будет слать сюда
-        drop_pending_updates=True,
-        allowed_updates=["message","callback_query","poll_answer"]
-    )
+    asyncio.run(serve(application))
@@ -0,0 +1,184 @@
+# metrics.py — метрики в текстовом формате Prometheus, без внешних зависимостей
+# - Counter / Gauge / Histogram с метками; запись потокобезопасна (пишет и поток БД)
+# - Gauge может считаться функцией в момент опроса (длины очередей, число пользователей)
+# - collect() отдаёт снимок семейств (его можно передать между процессами),
+#   render() собирает текст для /metrics из одного или нескольких снимков
+
+import bisect, threading, time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Sequence, Tuple
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+Labels = Tuple[Tuple[str, str], ...]
+# (имя сэмпла, метки, значение)
+Sample = Tuple[str, Labels, float]
+# (имя, тип, описание, сэмплы)
+Family = Tuple[str, str, str, List[Sample]]
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, doc: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.doc = doc
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+
+    def _key(self, values: Sequence) -> Tuple[str, ...]:
+        if len(values) != len(self.labels):
+            raise ValueError(f"{self.name}: expected labels {self.labels}, got {values!r}")
+        return tuple(str(v) for v in values)
+
+    def _labels(self, key: Tuple[str, ...]) -> Labels:
+        return tuple(zip(self.labels, key))
+
+    def samples(self) -> List[Sample]:
+        raise NotImplementedError
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, name: str, doc: str, labels: Sequence[str] = ()):
+        super().__init__(name, doc, labels)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, *labels, amount: float = 1.0):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def samples(self) -> List[Sample]:
+        with self._lock:
+            return [(self.name, self._labels(k), v) for k, v in self._values.items()]
+
+
+class Gauge(_Metric):
+    """Значение задаётся set() или считается функцией fn() при каждом опросе."""
+    kind = "gauge"
+
+    def __init__(self, name: str, doc: str, labels: Sequence[str] = (),
+                 fn: Optional[Callable[[], float]] = None):
+        super().__init__(name, doc, labels)
+        self._fn = fn
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def set(self, value: float, *labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def samples(self) -> List[Sample]:
+        if self._fn is not None:
+            return [(self.name, (), float(self._fn()))]
+        with self._lock:
+            return [(self.name, self._labels(k), v) for k, v in self._values.items()]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, doc: str, labels: Sequence[str] = (),
+                 buckets: Sequence[float] = DEFAULT_BUCKETS):
+        super().__init__(name, doc, labels)
+        self.buckets = tuple(sorted(buckets))
+        # метки → [счётчики по корзинам (+Inf последней), сумма]
+        self._values: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, *labels):
+        key = self._key(labels)
+        i = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is None:
+                entry = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][i] += 1
+            entry[1] += value
+
+    @contextmanager
+    def time(self, *labels):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t0, *labels)
+
+    def samples(self) -> List[Sample]:
+        out = []
+        with self._lock:
+            items = [(k, list(counts), total) for k, (counts, total) in self._values.items()]
+        for key, counts, total in items:
+            labels = self._labels(key)
+            acc = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                acc += n
+                out.append((f"{self.name}_bucket", labels + (("le", _fmt(bound)),), acc))
+            out.append((f"{self.name}_sum", labels, total))
+            out.append((f"{self.name}_count", labels, acc))
+        return out
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def counter(self, name: str, doc: str, labels: Sequence[str] = ()) -> Counter:
+        return self._add(Counter(name, doc, labels))
+
+    def gauge(self, name: str, doc: str, labels: Sequence[str] = (),
+              fn: Optional[Callable[[], float]] = None) -> Gauge:
+        return self._add(Gauge(name, doc, labels, fn))
+
+    def histogram(self, name: str, doc: str, labels: Sequence[str] = (),
+                  buckets: Sequence[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, doc, labels, buckets))
+
+    def collect(self, const_labels: Labels = ()) -> List[Family]:
+        """Снимок всех метрик; const_labels добавляются к каждому сэмплу (например, шард)."""
+        return [
+            (m.name, m.kind, m.doc, [(n, const_labels + lb, v) for n, lb, v in m.samples()])
+            for m in self._metrics
+        ]
+
+    def render(self) -> str:
+        return render([self.collect()])
+
+
+def _fmt(v: float) -> str:
+    if v == float("inf"):
+        return "+Inf"
+    if float(v).is_integer() and abs(v) < 1e15:
+        return str(int(v))
+    return repr(float(v))
+
+
+def _escape(v: str) -> str:
+    return v.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def render(snapshots: Iterable[List[Family]]) -> str:
+    """Текст для /metrics; семейства с одинаковым именем из разных снимков сливаются."""
+    merged: Dict[str, Family] = {}
+    for families in snapshots:
+        for name, kind, doc, samples in families:
+            if name in merged:
+                merged[name][3].extend(samples)
+            else:
+                merged[name] = (name, kind, doc, list(samples))
+    lines = []
+    for name, kind, doc, samples in merged.values():
+        lines.append(f"# HELP {name} {doc}")
+        lines.append(f"# TYPE {name} {kind}")
+        for sample, labels, value in samples:
+            if labels:
+                body = ",".join(f'{k}="{_escape(str(v))}"' for k, v in labels)
+                lines.append(f"{sample}{{{body}}} {_fmt(value)}")
+            else:
+                lines.append(f"{sample} {_fmt(value)}")
+    return "\n".join(lines) + "\n"
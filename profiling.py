@@ -0,0 +1,113 @@
+# profiling.py — профилирование живого процесса по команде админа
+# - сэмплер стеков: отдельный поток раз в interval снимает sys._current_frames()
+#   всех потоков (event loop, писатель БД, сборка отчёта в to_thread); пока не
+#   запущен — никаких накладных расходов
+# - tracemalloc на то же окно: где выделялась память (разница снимков)
+# - результат — текстовый отчёт для отправки документом
+
+import asyncio, os, sys, threading, time, tracemalloc
+from collections import Counter
+from typing import Dict, List, Tuple
+
+# Кадры «ожидания»: поток спит в select/очереди/lock — это не нагрузка на CPU
+_IDLE_FILES = ("selectors.py", "threading.py", "queue.py")
+
+
+def _where(code) -> str:
+    return f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})"
+
+
+class StackSampler:
+    def __init__(self, interval: float = 0.005):
+        self.interval = interval
+        self.samples = 0
+        self.idle = Counter()
+        self.self_time: Counter = Counter()      # функция на вершине стека
+        self.total_time: Counter = Counter()     # функция где-либо в стеке
+        self.stacks: Counter = Counter()         # свёрнутые стеки (формат flamegraph)
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="stack-sampler", daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        me = threading.get_ident()
+        names: Dict[int, str] = {}
+        while not self._stop.wait(self.interval):
+            self.samples += 1
+            for t in threading.enumerate():
+                names[t.ident] = t.name
+            for ident, frame in sys._current_frames().items():
+                if ident == me:
+                    continue
+                thread = names.get(ident, str(ident))
+                if os.path.basename(frame.f_code.co_filename) in _IDLE_FILES:
+                    self.idle[thread] += 1
+                    continue
+                chain: List[str] = []
+                while frame is not None:
+                    chain.append(_where(frame.f_code))
+                    frame = frame.f_back
+                self.self_time[chain[0]] += 1
+                for fn in set(chain):
+                    self.total_time[fn] += 1
+                self.stacks[";".join([thread] + chain[::-1])] += 1
+
+
+def _table(title: str, rows: List[Tuple[str, int]], samples: int) -> List[str]:
+    out = [title, "-" * len(title)]
+    for name, n in rows:
+        out.append(f"{n:7d} {100.0 * n / max(1, samples):6.1f}%  {name}")
+    return out + [""]
+
+
+async def profile(seconds: float, interval: float = 0.005, top: int = 40) -> str:
+    """Снимает профиль процесса за seconds секунд и возвращает текстовый отчёт."""
+    started_tracing = not tracemalloc.is_tracing()
+    if started_tracing:
+        tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    sampler = StackSampler(interval)
+    t0 = time.monotonic()
+    sampler.start()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        sampler.stop()
+        after = tracemalloc.take_snapshot()
+        current, peak = tracemalloc.get_traced_memory()
+        if started_tracing:
+            tracemalloc.stop()
+    elapsed = time.monotonic() - t0
+
+    busy = sum(sampler.self_time.values())
+    lines = [
+        f"Profile: {elapsed:.1f}s, {sampler.samples} samples every {interval * 1000:.0f}ms, "
+        f"pid {os.getpid()}",
+        f"Busy thread-samples: {busy}; idle by thread: "
+        + (", ".join(f"{k}={v}" for k, v in sampler.idle.most_common()) or "-"),
+        "",
+    ]
+    lines += _table("CPU: self (function on top of the stack)", sampler.self_time.most_common(top), busy)
+    lines += _table("CPU: total (function anywhere in the stack)", sampler.total_time.most_common(top), busy)
+
+    diff = await asyncio.to_thread(after.compare_to, before, "lineno")
+    stats = [s for s in diff if s.size_diff > 0][:top]
+    title = f"Memory: top allocation sites (traced now {current / 1e6:.1f} MB, peak {peak / 1e6:.1f} MB)"
+    lines += [title, "-" * len(title)]
+    for s in stats:
+        frame = s.traceback[0]
+        lines.append(f"{s.size_diff / 1024:10.1f} KiB {s.count_diff:+8d} blocks  "
+                     f"{os.path.basename(frame.filename)}:{frame.lineno}")
+    lines.append("")
+
+    lines.append("Stacks (folded, for flamegraph.pl / speedscope)")
+    lines.append("-----------------------------------------------")
+    for stack, n in sampler.stacks.most_common(2000):
+        lines.append(f"{stack} {n}")
+    return "\n".join(lines) + "\n"
@@ -9,9 +9,17 @@ fi
 source .venv/bin/activate
 python -V
 
-# deps
-python -m pip install --upgrade pip
-python -m pip install --no-cache-dir -r requirements.txt
+# deps: только если requirements.txt (или версия Python) изменились с прошлой установки —
+# холодный старт не тратит время на pip
+STAMP=".venv/.requirements.sha256"
+REQ_HASH="$( (python -V; cat requirements.txt) | sha256sum | cut -d' ' -f1 )"
+if [ "$(cat "$STAMP" 2>/dev/null)" != "$REQ_HASH" ]; then
+  python -m pip install --upgrade pip
+  python -m pip install --no-cache-dir -r requirements.txt
+  echo "$REQ_HASH" > "$STAMP"
+else
+  echo "requirements.txt unchanged, skipping pip install"
+fi
 
 # run
 exec python -u main.py
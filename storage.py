@@ -0,0 +1,839 @@
+# storage.py — слой хранения (SQLite) для квиз-бота
+# - одно долгоживущее соединение вместо connect() на каждый запрос
+# - схема создаётся один раз при открытии
+# - WAL + разумные PRAGMA, запросы кэшируются драйвером (cached_statements)
+# - WriteBehind: запись ответов/регистраций пачками в отдельном потоке,
+#   чтобы fsync не блокировал event loop
+# - агрегаты (agg_*) ведутся триггерами в той же транзакции, что и вставка,
+#   поэтому статус и сводки отчёта не сканируют сырые таблицы
+# - ответы: ключ (round, user_id, q_index), выбранные варианты — битовая маска
+# - state_log: журнал состояния попыток (дописывается, периодически сжимается
+#   до последней записи на пользователя) — по нему бот поднимается после рестарта
+# - раунды: ответы, регистрации и агрегаты привязаны к раунду; сброс = новый раунд
+#   (O(1)), сырые строки старых раундов чистятся порциями в фоне (purge_round),
+#   агрегаты архивных раундов остаются для сводок
+# - банк вопросов: версия целиком (banks) + вопросы по строкам с темой и сложностью
+#   (bank_questions) — вопрос читается по ключу, пулы для выборки — по индексу
+# - выгрузка: ответы потоково из курсора; answers.seq — номер записи для режима
+#   «только новое с прошлой выгрузки»
+
+import asyncio, functools, json, logging, queue, sqlite3, threading, time
+from typing import Any, Callable, Dict, Iterator, List, Optional, Set, Tuple
+
+log = logging.getLogger("quizbot.storage")
+
+# Наблюдатель за длительностью запросов: fn(имя, секунды). Ставит бот (метрики).
+_observer: Optional[Callable[[str, float], None]] = None
+
+def set_query_observer(fn: Optional[Callable[[str, float], None]]):
+    global _observer
+    _observer = fn
+
+def _timed(method):
+    name = method.__name__
+
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        if _observer is None:
+            return method(*args, **kwargs)
+        t0 = time.perf_counter()
+        try:
+            return method(*args, **kwargs)
+        finally:
+            _observer(name, time.perf_counter() - t0)
+    return wrapper
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS rounds(
+    round_id   INTEGER PRIMARY KEY AUTOINCREMENT,
+    started_at INTEGER NOT NULL DEFAULT (strftime('%s','now')),
+    archived   INTEGER NOT NULL DEFAULT 0   -- 1 — архивный (сырые строки чистятся, агрегаты остались),
+                                            -- 2 — чистка завершена
+);
+CREATE TABLE IF NOT EXISTS users(
+    round   INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    country TEXT,
+    PRIMARY KEY(round, user_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS answers(
+    round   INTEGER NOT NULL,
+    user_id INTEGER NOT NULL,
+    q_index INTEGER NOT NULL,
+    mask    INTEGER NOT NULL,  -- выбранные варианты: бит i = вариант i
+    correct INTEGER NOT NULL,
+    bank    INTEGER NOT NULL DEFAULT 0,  -- версия банка вопросов (banks.bank_id)
+    seq     INTEGER NOT NULL DEFAULT 0,  -- порядковый номер записи (инкрементальная выгрузка)
+    PRIMARY KEY(round, user_id, q_index)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS answers_seq ON answers(seq);
+CREATE TABLE IF NOT EXISTS banks(
+    bank_id    INTEGER PRIMARY KEY AUTOINCREMENT,
+    sha        TEXT NOT NULL UNIQUE,   -- sha256 канонического JSON
+    data       TEXT NOT NULL,          -- исходный JSON банка
+    created_at INTEGER NOT NULL DEFAULT (strftime('%s','now'))
+);
+-- Вопросы банка по одному: билет участника читает только свои вопросы по ключу,
+-- пулы (тема, сложность) — по индексу, без разбора всего банка
+CREATE TABLE IF NOT EXISTS bank_questions(
+    bank       INTEGER NOT NULL,
+    q_index    INTEGER NOT NULL,
+    topic      TEXT NOT NULL DEFAULT '',
+    difficulty INTEGER NOT NULL DEFAULT 0,
+    data       TEXT NOT NULL,   -- JSON вопроса: text, options, correct_indices, multiple
+    PRIMARY KEY(bank, q_index)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS bank_questions_pool ON bank_questions(bank, topic, difficulty, q_index);
+CREATE TABLE IF NOT EXISTS meta(
+    key   TEXT PRIMARY KEY,
+    value TEXT
+);
+CREATE TABLE IF NOT EXISTS media(
+    key        TEXT PRIMARY KEY,   -- URL или хеш содержимого/данных
+    kind       TEXT NOT NULL,      -- animation / document / …
+    file_id    TEXT NOT NULL,
+    updated_at INTEGER NOT NULL DEFAULT (strftime('%s','now'))
+);
+CREATE TABLE IF NOT EXISTS state_log(
+    seq      INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id  INTEGER NOT NULL,
+    round    INTEGER NOT NULL,
+    bank     INTEGER NOT NULL,
+    q_index  INTEGER NOT NULL,
+    poll_id  TEXT,              -- открытый опрос (NULL — нет)
+    deadline REAL,              -- unix-время истечения открытого опроса
+    finished INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS state_log_user ON state_log(user_id);
+CREATE INDEX IF NOT EXISTS state_log_round ON state_log(round);   -- чистка архивного раунда
+
+CREATE TABLE IF NOT EXISTS agg_country(
+    round        INTEGER NOT NULL,
+    country      TEXT NOT NULL,
+    registered   INTEGER NOT NULL DEFAULT 0,
+    participants INTEGER NOT NULL DEFAULT 0,   -- пользователей хотя бы с одним ответом
+    answered     INTEGER NOT NULL DEFAULT 0,
+    correct      INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY(round, country)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS agg_country_question(
+    round    INTEGER NOT NULL,
+    country  TEXT NOT NULL,
+    q_index  INTEGER NOT NULL,
+    answered INTEGER NOT NULL DEFAULT 0,
+    correct  INTEGER NOT NULL DEFAULT 0,
+    PRIMARY KEY(round, country, q_index)
+) WITHOUT ROWID;
+
+-- Удаления из архивируемого раунда (чистка сырых строк) агрегаты не трогают.
+CREATE TRIGGER IF NOT EXISTS users_ai AFTER INSERT ON users WHEN NEW.country IS NOT NULL BEGIN
+    INSERT INTO agg_country(round, country, registered) VALUES(NEW.round, NEW.country, 1)
+        ON CONFLICT(round, country) DO UPDATE SET registered = registered + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS users_au AFTER UPDATE OF country ON users
+WHEN OLD.country IS NOT NEW.country BEGIN
+    UPDATE agg_country SET registered = registered - 1 WHERE round = OLD.round AND country = OLD.country;
+    INSERT INTO agg_country(round, country, registered) SELECT NEW.round, NEW.country, 1
+        WHERE NEW.country IS NOT NULL
+        ON CONFLICT(round, country) DO UPDATE SET registered = registered + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS users_ad AFTER DELETE ON users
+WHEN OLD.country IS NOT NULL
+ AND NOT EXISTS(SELECT 1 FROM rounds WHERE round_id = OLD.round AND archived) BEGIN
+    UPDATE agg_country SET registered = registered - 1 WHERE round = OLD.round AND country = OLD.country;
+END;
+
+CREATE TRIGGER IF NOT EXISTS answers_ai AFTER INSERT ON answers BEGIN
+    INSERT INTO agg_country(round, country, participants, answered, correct) VALUES(
+        NEW.round,
+        COALESCE((SELECT country FROM users WHERE round = NEW.round AND user_id = NEW.user_id), '?'),
+        NOT EXISTS(SELECT 1 FROM answers WHERE round = NEW.round AND user_id = NEW.user_id
+                   AND q_index <> NEW.q_index),
+        1, NEW.correct
+    ) ON CONFLICT(round, country) DO UPDATE SET
+        participants = participants + excluded.participants,
+        answered = answered + 1,
+        correct = correct + excluded.correct;
+    INSERT INTO agg_country_question(round, country, q_index, answered, correct) VALUES(
+        NEW.round,
+        COALESCE((SELECT country FROM users WHERE round = NEW.round AND user_id = NEW.user_id), '?'),
+        NEW.q_index, 1, NEW.correct
+    ) ON CONFLICT(round, country, q_index) DO UPDATE SET
+        answered = answered + 1,
+        correct = correct + excluded.correct;
+END;
+CREATE TRIGGER IF NOT EXISTS answers_ad AFTER DELETE ON answers
+WHEN NOT EXISTS(SELECT 1 FROM rounds WHERE round_id = OLD.round AND archived) BEGIN
+    UPDATE agg_country SET
+        participants = participants - NOT EXISTS(SELECT 1 FROM answers
+                                                 WHERE round = OLD.round AND user_id = OLD.user_id),
+        answered = answered - 1,
+        correct = correct - OLD.correct
+    WHERE round = OLD.round
+      AND country = COALESCE((SELECT country FROM users WHERE round = OLD.round AND user_id = OLD.user_id), '?');
+    UPDATE agg_country_question SET
+        answered = answered - 1,
+        correct = correct - OLD.correct
+    WHERE round = OLD.round
+      AND country = COALESCE((SELECT country FROM users WHERE round = OLD.round AND user_id = OLD.user_id), '?')
+      AND q_index = OLD.q_index;
+END;
+"""
+
+# Пересчёт агрегатов с нуля — для баз, созданных до появления agg_* или до раундов.
+# Архивные раунды не трогаем: сырых строк у них уже нет, агрегаты — единственная копия.
+REBUILD_AGGREGATES = """
+DELETE FROM agg_country WHERE round NOT IN (SELECT round_id FROM rounds WHERE archived);
+DELETE FROM agg_country_question WHERE round NOT IN (SELECT round_id FROM rounds WHERE archived);
+INSERT INTO agg_country(round, country, registered)
+    SELECT round, country, COUNT(*) FROM users WHERE country IS NOT NULL GROUP BY round, country;
+INSERT INTO agg_country(round, country, participants, answered, correct)
+    SELECT a.round, COALESCE(u.country,'?'), COUNT(DISTINCT a.user_id), COUNT(*), SUM(a.correct)
+    FROM answers a LEFT JOIN users u ON u.round = a.round AND u.user_id = a.user_id
+    GROUP BY 1, 2 ORDER BY 1, 2
+    ON CONFLICT(round, country) DO UPDATE SET
+        participants = excluded.participants, answered = excluded.answered, correct = excluded.correct;
+INSERT INTO agg_country_question(round, country, q_index, answered, correct)
+    SELECT a.round, COALESCE(u.country,'?'), a.q_index, COUNT(*), SUM(a.correct)
+    FROM answers a LEFT JOIN users u ON u.round = a.round AND u.user_id = a.user_id GROUP BY 1, 2, 3;
+"""
+
+# PRAGMA user_version: 0 — исходная схема, 1 — агрегаты, 2 — компактные ответы,
+# 3 — версии банка вопросов (answers.bank), 4 — журнал состояния (state_log),
+# 5 — раунды (rounds; users и agg_* с ключом по раунду), 6 — вопросы банка по строкам
+# (bank_questions; для старых банков заполняется при первой загрузке), 7 — answers.seq,
+# 8 — rounds.archived=2 (чистка завершена) и индекс state_log(round)
+SCHEMA_VERSION = 8
+DEFAULT_ROUND = 1
+
+PRAGMAS = (
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",   # в WAL безопасно: теряется максимум последняя транзакция при сбое ОС
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-16000",    # ~16 МБ страничного кэша
+)
+
+SQL_UPSERT_USER = (
+    "INSERT INTO users(round,user_id,country) VALUES(?,?,?) "
+    "ON CONFLICT(round,user_id) DO UPDATE SET country=excluded.country"
+)
+# Повторный ответ на тот же вопрос (дубль апдейта) не перезаписывает первый.
+# seq — следующий номер по индексу answers_seq; выдаётся под блокировкой записи,
+# поэтому порядок seq совпадает с порядком коммитов всех шардов.
+SQL_INSERT_ANSWER = (
+    "INSERT INTO answers(round,user_id,q_index,mask,correct,bank,seq) "
+    "VALUES(?,?,?,?,?,?,(SELECT COALESCE(MAX(seq),0)+1 FROM answers)) "
+    "ON CONFLICT(round,user_id,q_index) DO NOTHING"
+)
+SQL_DELETE_USER_ANSWERS = "DELETE FROM answers WHERE round=? AND user_id=?"
+SQL_SET_MEDIA = (
+    "INSERT INTO media(key,kind,file_id) VALUES(?,?,?) "
+    "ON CONFLICT(key) DO UPDATE SET kind=excluded.kind, file_id=excluded.file_id, "
+    "updated_at=strftime('%s','now')"
+)
+SQL_DROP_MEDIA = "DELETE FROM media WHERE key=?"
+# Счётчик изменений данных: +1 за каждую пачку записи (ключ кэша отчёта)
+SQL_BUMP_DATA_VERSION = (
+    "INSERT INTO meta(key,value) VALUES('data_version',1) "
+    "ON CONFLICT(key) DO UPDATE SET value=CAST(value AS INTEGER)+1"
+)
+SQL_LOG_STATE = (
+    "INSERT INTO state_log(user_id,round,bank,q_index,poll_id,deadline,finished) VALUES(?,?,?,?,?,?,?)"
+)
+SQL_DROP_STATE = "DELETE FROM state_log WHERE user_id=?"
+# Сжатие журнала: по каждому пользователю остаётся только последняя запись
+SQL_COMPACT_STATE = (
+    "DELETE FROM state_log WHERE seq NOT IN (SELECT MAX(seq) FROM state_log GROUP BY user_id)"
+)
+# Архивация раунда: пометка (после неё удаления не трогают агрегаты) и чистка
+# сырых строк порциями — каждая порция короткая транзакция, писатель не ждёт
+SQL_ARCHIVE_ROUND = "UPDATE rounds SET archived=1 WHERE round_id=? AND NOT archived"
+SQL_PURGED_ROUND = "UPDATE rounds SET archived=2 WHERE round_id=?"
+# Раунды за пределами keep новейших, у которых чистка не завершена
+SQL_ROUNDS_TO_PURGE = (
+    "SELECT round_id FROM (SELECT round_id, archived FROM rounds ORDER BY round_id DESC LIMIT -1 OFFSET ?) "
+    "WHERE archived < 2 ORDER BY round_id DESC"
+)
+SQL_PURGE_ROUND = (
+    "DELETE FROM state_log WHERE seq IN (SELECT seq FROM state_log WHERE round=?1 LIMIT ?2)",
+    "DELETE FROM answers WHERE round=?1 AND user_id IN "
+    "(SELECT DISTINCT user_id FROM answers WHERE round=?1 LIMIT ?2)",
+    "DELETE FROM users WHERE round=?1 AND user_id IN "
+    "(SELECT user_id FROM users WHERE round=?1 LIMIT ?2)",
+)
+
+def options_mask(option_ids) -> int:
+    mask = 0
+    for i in option_ids:
+        mask |= 1 << i
+    return mask
+
+def mask_options(mask: int) -> List[int]:
+    out, i = [], 0
+    while mask:
+        if mask & 1:
+            out.append(i)
+        mask >>= 1
+        i += 1
+    return out
+
+# (q_index, тема, сложность, JSON вопроса)
+BankQuestionRow = Tuple[int, str, int, str]
+# (round, user_id, q_index, маска, верно ли, bank_id)
+AnswerRecord = Tuple[int, int, int, int, bool, int]
+# (seq, round, страна, user_id, q_index, маска, верно ли, bank_id) — строка выгрузки
+ExportRow = Tuple[int, int, str, int, int, int, int, int]
+# (q_index, выбранные варианты, верно ли)
+AnswerRow = Tuple[int, List[int], bool]
+# (user_id, round, bank_id, q_index, poll_id, deadline, finished)
+StateRecord = Tuple[int, int, int, int, Optional[str], Optional[float], bool]
+
+def _migrate_answers_v2(conn: sqlite3.Connection):
+    """answers(user_id, q_index, option_ids JSON, correct) → компактная схема с маской.
+    Старая таблица переименовывается, новая создаётся SCHEMA, данные переносятся в _finish."""
+    cols = [r[1] for r in conn.execute("PRAGMA table_info(answers)")]
+    if "option_ids" not in cols:
+        return False
+    with conn:
+        conn.execute("DROP TRIGGER IF EXISTS answers_ai")
+        conn.execute("DROP TRIGGER IF EXISTS answers_ad")
+        conn.execute("DROP INDEX IF EXISTS answers_user")
+        conn.execute("ALTER TABLE answers RENAME TO answers_v1")
+    return True
+
+def _finish_answers_v2(conn: sqlite3.Connection):
+    def rows():
+        for uid, qidx, opt_json, ok in conn.execute(
+            "SELECT user_id, q_index, option_ids, correct FROM answers_v1 ORDER BY rowid"
+        ):
+            try:
+                chosen = json.loads(opt_json) if opt_json else []
+            except ValueError:
+                chosen = []
+            yield (DEFAULT_ROUND, uid, qidx, options_mask(chosen), int(bool(ok)), 0)
+    with conn:
+        conn.executemany(SQL_INSERT_ANSWER, list(rows()))
+        conn.execute("DROP TABLE answers_v1")
+    log.info("Migrated answers table to compact schema")
+
+def _migrate_answers_v3(conn: sqlite3.Connection):
+    cols = [r[1] for r in conn.execute("PRAGMA table_info(answers)")]
+    if "bank" not in cols:
+        with conn:
+            conn.execute("ALTER TABLE answers ADD COLUMN bank INTEGER NOT NULL DEFAULT 0")
+
+def _migrate_answers_v7(conn: sqlite3.Connection):
+    """answers.seq: до SCHEMA — индекс answers_seq создаётся уже по новой колонке.
+    Старые строки получают seq=0 и попадают в первую инкрементальную выгрузку."""
+    cols = [r[1] for r in conn.execute("PRAGMA table_info(answers)")]
+    if cols and "seq" not in cols:
+        with conn:
+            conn.execute("ALTER TABLE answers ADD COLUMN seq INTEGER NOT NULL DEFAULT 0")
+
+def _migrate_rounds_v5(conn: sqlite3.Connection):
+    """users(user_id, country) → users(round, user_id, country); agg_* получают ключ раунда.
+    Агрегаты пересчитываются целиком, регистрации переносятся в текущий раунд в _finish."""
+    cols = [r[1] for r in conn.execute("PRAGMA table_info(users)")]
+    if not cols or "round" in cols:
+        return False
+    with conn:
+        for trigger in ("users_ai", "users_au", "users_ad", "answers_ai", "answers_ad"):
+            conn.execute(f"DROP TRIGGER IF EXISTS {trigger}")
+        conn.execute("DROP TABLE IF EXISTS agg_country")
+        conn.execute("DROP TABLE IF EXISTS agg_country_question")
+        conn.execute("ALTER TABLE users RENAME TO users_v4")
+    return True
+
+def _finish_rounds_v5(conn: sqlite3.Connection):
+    row = conn.execute("SELECT value FROM meta WHERE key='round'").fetchone()
+    current = int(row[0]) if row else DEFAULT_ROUND
+    with conn:
+        conn.execute("INSERT OR IGNORE INTO rounds(round_id) SELECT DISTINCT round FROM answers")
+        conn.execute("INSERT INTO users(round,user_id,country) SELECT ?, user_id, country FROM users_v4",
+                     (current,))
+        conn.execute("DROP TABLE users_v4")
+    log.info("Migrated users and aggregates to round-scoped schema (round %d)", current)
+
+
+class Storage:
+    """Долгоживущее соединение с SQLite. Методы потокобезопасны (общий lock)."""
+
+    def __init__(self, path: str):
+        self.path = path
+        self._conn: Optional[sqlite3.Connection] = None
+        self._lock = threading.RLock()
+
+    # ---------- жизненный цикл ----------
+    def open(self, init_schema: bool = True) -> "Storage":
+        if self._conn is not None:
+            return self
+        conn = sqlite3.connect(self.path, check_same_thread=False, cached_statements=128)
+        for pragma in PRAGMAS:
+            conn.execute(pragma)
+        if init_schema:
+            version = conn.execute("PRAGMA user_version").fetchone()[0]
+            migrate_v2 = version < 2 and _migrate_answers_v2(conn)
+            migrate_v5 = version < 5 and _migrate_rounds_v5(conn)
+            if version < 7:
+                _migrate_answers_v7(conn)
+            with conn:
+                conn.executescript(SCHEMA)
+            if migrate_v2:
+                _finish_answers_v2(conn)
+            if version < 3:
+                _migrate_answers_v3(conn)
+            if migrate_v5:
+                _finish_rounds_v5(conn)
+            with conn:
+                conn.execute(
+                    "INSERT OR IGNORE INTO rounds(round_id) "
+                    "SELECT COALESCE((SELECT CAST(value AS INTEGER) FROM meta WHERE key='round'), ?)",
+                    (DEFAULT_ROUND,)
+                )
+            if version < 1 or migrate_v2 or migrate_v5:
+                conn.executescript("BEGIN;" + REBUILD_AGGREGATES + "COMMIT;")
+            if version < SCHEMA_VERSION:
+                conn.execute(f"PRAGMA user_version={SCHEMA_VERSION}")
+        self._conn = conn
+        return self
+
+    def close(self):
+        with self._lock:
+            if self._conn is not None:
+                self._conn.close()
+                self._conn = None
+
+    @property
+    def conn(self) -> sqlite3.Connection:
+        if self._conn is None:
+            raise RuntimeError(f"Storage({self.path}) is not open")
+        return self._conn
+
+    # ---------- пользователи ----------
+    def register_user(self, round_id: int, user_id: int, country: str):
+        self.register_users([(round_id, user_id, country)])
+
+    def register_users(self, rows: List[Tuple[int, int, str]]):
+        """rows: (round, user_id, country)."""
+        with self._lock, self.conn:
+            self.conn.executemany(SQL_UPSERT_USER, rows)
+
+    @_timed
+    def registered_users(self, round_id: int) -> List[int]:
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT user_id FROM users WHERE round=? AND country IS NOT NULL", (round_id,)
+            ).fetchall()
+        return [r[0] for r in rows]
+
+    @_timed
+    def answered_users(self, round_id: int) -> Set[int]:
+        """Кто уже отвечал в раунде: повторная попытка без /again упрётся в DO NOTHING."""
+        with self._lock:
+            rows = self.conn.execute("SELECT DISTINCT user_id FROM answers WHERE round=?", (round_id,)).fetchall()
+        return {r[0] for r in rows}
+
+    @_timed
+    def country_counts(self, round_id: int) -> List[Tuple[str, int]]:
+        with self._lock:
+            return self.conn.execute(
+                "SELECT country, registered FROM agg_country WHERE round=? AND registered > 0 ORDER BY country",
+                (round_id,)
+            ).fetchall()
+
+    # ---------- медиа (кэш file_id) ----------
+    @_timed
+    def media_ids(self) -> Dict[str, str]:
+        with self._lock:
+            return dict(self.conn.execute("SELECT key, file_id FROM media").fetchall())
+
+    @_timed
+    def data_version(self) -> int:
+        with self._lock:
+            row = self.conn.execute("SELECT value FROM meta WHERE key='data_version'").fetchone()
+        return int(row[0]) if row else 0
+
+    @_timed
+    def get_meta(self, key: str) -> Optional[str]:
+        with self._lock:
+            row = self.conn.execute("SELECT value FROM meta WHERE key=?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def set_meta(self, key: str, value: Optional[str]):
+        """value=None — удалить ключ."""
+        with self._lock, self.conn:
+            if value is None:
+                self.conn.execute("DELETE FROM meta WHERE key=?", (key,))
+            else:
+                self.conn.execute(
+                    "INSERT INTO meta(key,value) VALUES(?,?) ON CONFLICT(key) DO UPDATE SET value=excluded.value",
+                    (key, value)
+                )
+
+    # ---------- раунд ----------
+    @_timed
+    def current_round(self) -> int:
+        with self._lock:
+            row = self.conn.execute("SELECT value FROM meta WHERE key='round'").fetchone()
+        return int(row[0]) if row else DEFAULT_ROUND
+
+    def new_round(self) -> int:
+        """Открывает новый раунд и делает его текущим. Данные прошлых раундов не трогает —
+        это две строки, а не удаление всего, поэтому сброс не зависит от объёма базы."""
+        with self._lock, self.conn:
+            round_id = self.conn.execute("INSERT INTO rounds DEFAULT VALUES").lastrowid
+            self.conn.execute(
+                "INSERT INTO meta(key,value) VALUES('round',?) ON CONFLICT(key) DO UPDATE SET value=excluded.value",
+                (round_id,)
+            )
+        return round_id
+
+    @_timed
+    def rounds(self) -> List[Tuple[int, int, bool]]:
+        """(round_id, started_at, archived) — от новых к старым."""
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT round_id, started_at, archived FROM rounds ORDER BY round_id DESC"
+            ).fetchall()
+        return [(rid, started, bool(arch)) for rid, started, arch in rows]
+
+    def rounds_to_purge(self, keep: int) -> List[int]:
+        """Раунды старше keep новейших, ещё не дочищенные (прерванная чистка догоняется)."""
+        with self._lock:
+            return [r[0] for r in self.conn.execute(SQL_ROUNDS_TO_PURGE, (keep,)).fetchall()]
+
+    def archive_round(self, round_id: int):
+        with self._lock, self.conn:
+            self.conn.execute(SQL_ARCHIVE_ROUND, (round_id,))
+
+    def purge_round(self, round_id: int, limit: int = 1000) -> int:
+        """Одна порция чистки сырых строк архивного раунда; 0 — чистить больше нечего
+        (раунд помечается дочищенным и больше не просматривается)."""
+        with self._lock, self.conn:
+            purged = sum(self.conn.execute(sql, (round_id, limit)).rowcount for sql in SQL_PURGE_ROUND)
+            if not purged:
+                self.conn.execute(SQL_PURGED_ROUND, (round_id,))
+            return purged
+
+    # ---------- банки вопросов ----------
+    @_timed
+    def save_bank(self, sha: str, data: str, questions: List[BankQuestionRow] = ()) -> int:
+        """Сохраняет версию банка (если такой ещё нет) вместе с вопросами и возвращает её bank_id."""
+        with self._lock, self.conn:
+            self.conn.execute("INSERT INTO banks(sha,data) VALUES(?,?) ON CONFLICT(sha) DO NOTHING", (sha, data))
+            bank_id = self.conn.execute("SELECT bank_id FROM banks WHERE sha=?", (sha,)).fetchone()[0]
+            self._save_bank_questions(bank_id, questions)
+        return bank_id
+
+    def save_bank_questions(self, bank_id: int, questions: List[BankQuestionRow]):
+        with self._lock, self.conn:
+            self._save_bank_questions(bank_id, questions)
+
+    def _save_bank_questions(self, bank_id: int, questions: List[BankQuestionRow]):
+        self.conn.executemany(
+            "INSERT INTO bank_questions(bank,q_index,topic,difficulty,data) VALUES(?,?,?,?,?) "
+            "ON CONFLICT(bank,q_index) DO NOTHING",
+            [(bank_id, *row) for row in questions]
+        )
+
+    @_timed
+    def bank_index(self, bank_id: int) -> Optional[Tuple[str, List[Tuple[str, int, int]]]]:
+        """(sha, [(тема, сложность, q_index)…]) — без текстов вопросов; None — банка нет.
+        Пустой список — банк сохранён до появления bank_questions."""
+        with self._lock:
+            row = self.conn.execute("SELECT sha FROM banks WHERE bank_id=?", (bank_id,)).fetchone()
+            if row is None:
+                return None
+            rows = self.conn.execute(
+                "SELECT topic, difficulty, q_index FROM bank_questions WHERE bank=? "
+                "ORDER BY topic, difficulty, q_index", (bank_id,)
+            ).fetchall()
+        return row[0], rows
+
+    @_timed
+    def bank_question(self, bank_id: int, q_index: int) -> Optional[str]:
+        with self._lock:
+            row = self.conn.execute(
+                "SELECT data FROM bank_questions WHERE bank=? AND q_index=?", (bank_id, q_index)
+            ).fetchone()
+        return row[0] if row else None
+
+    @_timed
+    def load_bank(self, bank_id: int) -> Optional[str]:
+        with self._lock:
+            row = self.conn.execute("SELECT data FROM banks WHERE bank_id=?", (bank_id,)).fetchone()
+        return row[0] if row else None
+
+    @_timed
+    def has_bank(self, bank_id: int, sha: str) -> bool:
+        with self._lock:
+            return self.conn.execute(
+                "SELECT 1 FROM banks WHERE bank_id=? AND sha=?", (bank_id, sha)
+            ).fetchone() is not None
+
+    # ---------- ответы ----------
+    def record_answer(self, round_id: int, user_id: int, q_index: int, mask: int, correct: bool,
+                      bank_id: int = 0):
+        self.record_answers([(round_id, user_id, q_index, mask, correct, bank_id)])
+
+    def record_answers(self, rows: List[AnswerRecord]):
+        with self._lock, self.conn:
+            self.conn.executemany(SQL_INSERT_ANSWER, rows)
+
+    @_timed
+    def user_answers(self, round_id: int, user_id: int) -> List[AnswerRow]:
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT q_index, mask, correct FROM answers WHERE round=? AND user_id=? ORDER BY q_index",
+                (round_id, user_id)
+            ).fetchall()
+        return [(qidx, mask_options(mask), bool(ok)) for qidx, mask, ok in rows]
+
+    def iter_answers(self, round_id: int, chunk: int = 1000) -> Iterator[Tuple[str, int, int, int, int]]:
+        """Потоково: (страна, user_id, q_index, маска, correct) раунда, по chunk строк за раз."""
+        return self._stream(
+            "SELECT COALESCE(u.country,'?'), a.user_id, a.q_index, a.mask, a.correct "
+            "FROM answers a LEFT JOIN users u ON u.round = a.round AND u.user_id = a.user_id "
+            "WHERE a.round=?", (round_id,), chunk
+        )
+
+    def last_answer_seq(self) -> int:
+        """Верхняя граница выгрузки: всё с seq <= неё уже закоммичено."""
+        with self._lock:
+            return self.conn.execute("SELECT COALESCE(MAX(seq),0) FROM answers").fetchone()[0]
+
+    def iter_export(self, round_id: int, until: int, since: Optional[int] = None,
+                    chunk: int = 5000) -> Iterator[ExportRow]:
+        """Потоково: ответы раунда с seq <= until; since — только новее отметки прошлой
+        выгрузки (по индексу answers_seq), иначе весь раунд (по первичному ключу)."""
+        select = "SELECT a.seq, a.round, COALESCE(u.country,'?'), a.user_id, a.q_index, a.mask, a.correct, a.bank "
+        join = "LEFT JOIN users u ON u.round = a.round AND u.user_id = a.user_id "
+        if since is None:
+            return self._stream(select + "FROM answers a " + join + "WHERE a.round=? AND +a.seq<=?",
+                                (round_id, until), chunk)
+        # без подсказки планировщик берёт первичный ключ (весь раунд) и сортирует его
+        return self._stream(select + "FROM answers a INDEXED BY answers_seq " + join +
+                            "WHERE a.seq>? AND a.seq<=? AND a.round=? ORDER BY a.seq",
+                            (since, until, round_id), chunk)
+
+    def _stream(self, sql: str, params: tuple, chunk: int) -> Iterator[tuple]:
+        with self._lock:
+            cur = self.conn.execute(sql, params)
+        while True:
+            with self._lock:
+                rows = cur.fetchmany(chunk)
+            if not rows:
+                return
+            yield from rows
+
+    # ---------- журнал состояния попыток ----------
+    @_timed
+    def load_state(self, round_id: int) -> List[StateRecord]:
+        """Последняя запись журнала по каждому пользователю раунда."""
+        with self._lock:
+            rows = self.conn.execute(
+                "SELECT user_id, round, bank, q_index, poll_id, deadline, finished FROM state_log "
+                "WHERE seq IN (SELECT MAX(seq) FROM state_log GROUP BY user_id) AND round=?",
+                (round_id,)
+            ).fetchall()
+        return [(uid, rnd, bank, qidx, poll, dl, bool(fin)) for uid, rnd, bank, qidx, poll, dl, fin in rows]
+
+    @_timed
+    def compact_state(self) -> int:
+        with self._lock, self.conn:
+            return self.conn.execute(SQL_COMPACT_STATE).rowcount
+
+    # ---------- агрегаты для отчёта ----------
+    @_timed
+    def country_summary(self, round_id: int) -> List[Tuple[str, int, int, int]]:
+        """(страна, участников, ответов, правильных) раунда — из agg_country."""
+        with self._lock:
+            return self.conn.execute(
+                "SELECT country, participants, answered, correct FROM agg_country "
+                "WHERE round=? AND answered > 0 ORDER BY country", (round_id,)
+            ).fetchall()
+
+    @_timed
+    def country_question_summary(self, round_id: int) -> List[Tuple[str, int, int, int]]:
+        """(страна, q_index, ответов, правильных) раунда — из agg_country_question."""
+        with self._lock:
+            return self.conn.execute(
+                "SELECT country, q_index, answered, correct FROM agg_country_question "
+                "WHERE round=? AND answered > 0 ORDER BY country, q_index", (round_id,)
+            ).fetchall()
+
+    # ---------- сброс ----------
+    def delete_user_answers(self, round_id: int, user_id: int):
+        with self._lock, self.conn:
+            self.conn.execute(SQL_DELETE_USER_ANSWERS, (round_id, user_id))
+
+
+# ---------- ОТЛОЖЕННАЯ ЗАПИСЬ ----------
+_STOP = object()
+_DATA_OPS = {"answer", "user", "delete_user"}   # меняют данные отчёта
+
+class WriteBehind:
+    """Очередь записи с отдельным потоком-писателем и своим соединением.
+
+    Операции применяются строго в порядке постановки; подряд идущие операции
+    одного типа уходят одним executemany. Пачка коммитится не позже чем через
+    max_delay секунд после первой операции в ней. flush() даёт read-your-writes:
+    завершается, когда всё поставленное до него закоммичено.
+    """
+
+    def __init__(self, path: str, max_batch: int = 500, max_delay: float = 0.05,
+                 compact_every: int = 50_000):
+        self.path = path
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.compact_every = compact_every   # записей журнала состояния между сжатиями
+        self._state_rows = 0
+        self._q: "queue.Queue[Any]" = queue.Queue()
+        self._thread: Optional[threading.Thread] = None
+        self.written = 0   # применённых операций (для логов/метрик)
+
+    def start(self):
+        if self._thread is not None:
+            return
+        store = Storage(self.path).open()
+        self._thread = threading.Thread(target=self._run, args=(store,), name="db-writer", daemon=True)
+        self._thread.start()
+
+    def close(self):
+        """Дописывает всё из очереди и останавливает поток."""
+        if self._thread is None:
+            return
+        self._q.put(_STOP)
+        self._thread.join()
+        self._thread = None
+
+    @property
+    def pending(self) -> int:
+        return self._q.qsize()
+
+    # ---------- операции ----------
+    def record_answer(self, round_id: int, user_id: int, q_index: int, mask: int, correct: bool,
+                      bank_id: int = 0):
+        self._q.put(("answer", (round_id, user_id, q_index, mask, int(correct), bank_id)))
+
+    def register_user(self, round_id: int, user_id: int, country: str):
+        self._q.put(("user", (round_id, user_id, country)))
+
+    def delete_user_answers(self, round_id: int, user_id: int):
+        self._q.put(("delete_user", (round_id, user_id)))
+
+    def set_media(self, key: str, kind: str, file_id: str):
+        self._q.put(("media_set", (key, kind, file_id)))
+
+    def drop_media(self, key: str):
+        self._q.put(("media_drop", (key,)))
+
+    def log_state(self, record: StateRecord):
+        uid, round_id, bank_id, q_index, poll_id, deadline, finished = record
+        self._q.put(("state", (uid, round_id, bank_id, q_index, poll_id, deadline, int(finished))))
+
+    def drop_state(self, user_id: int):
+        self._q.put(("state_drop", (user_id,)))
+
+    def compact_state(self):
+        self._q.put(("state_compact", None))
+
+    async def flush(self):
+        if self._thread is None:
+            return
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        self._q.put(("barrier", (loop, fut)))
+        await fut
+
+    # ---------- поток-писатель ----------
+    def _collect(self) -> List[Any]:
+        batch = [self._q.get()]
+        deadline = time.monotonic() + self.max_delay
+        while len(batch) < self.max_batch and batch[-1] is not _STOP:
+            left = deadline - time.monotonic()
+            if left <= 0:
+                break
+            try:
+                batch.append(self._q.get(timeout=left))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self, store: Storage):
+        stop = False
+        while not stop:
+            batch = self._collect()
+            if batch[-1] is _STOP:
+                batch.pop()
+                stop = True
+                # всё, что успели поставить до остановки, тоже пишем
+                while not self._q.empty():
+                    item = self._q.get_nowait()
+                    if item is not _STOP:
+                        batch.append(item)
+            barriers = [arg for kind, arg in batch if kind == "barrier"]
+            ops = [(kind, arg) for kind, arg in batch if kind != "barrier"]
+            if ops:
+                t0 = time.perf_counter()
+                try:
+                    self._apply(store, ops)
+                except Exception:
+                    log.exception("Batch write failed, retrying one by one")
+                    for op in ops:
+                        try:
+                            self._apply(store, [op])
+                        except Exception:
+                            log.exception("Write dropped: %r", op)
+                self.written += len(ops)
+                if _observer is not None:
+                    _observer("write_batch", time.perf_counter() - t0)
+                self._state_rows += sum(kind == "state" for kind, _ in ops)
+                if self._state_rows >= self.compact_every:
+                    self._state_rows = 0
+                    try:
+                        self._apply(store, [("state_compact", None)])
+                    except Exception:
+                        log.exception("State log compaction failed")
+            for loop, fut in barriers:
+                try:
+                    loop.call_soon_threadsafe(_resolve, fut)
+                except RuntimeError:   # loop уже закрыт (остановка бота)
+                    pass
+        store.close()
+
+    @staticmethod
+    def _apply(store: Storage, ops: List[Tuple[str, Any]]):
+        conn = store.conn
+        with conn:
+            if any(kind in _DATA_OPS for kind, _ in ops):
+                conn.execute(SQL_BUMP_DATA_VERSION)
+            i = 0
+            while i < len(ops):
+                kind = ops[i][0]
+                j = i
+                while j < len(ops) and ops[j][0] == kind:
+                    j += 1
+                args = [arg for _, arg in ops[i:j]]
+                if kind == "answer":
+                    conn.executemany(SQL_INSERT_ANSWER, args)
+                elif kind == "user":
+                    conn.executemany(SQL_UPSERT_USER, args)
+                elif kind == "delete_user":
+                    conn.executemany(SQL_DELETE_USER_ANSWERS, args)
+                elif kind == "media_set":
+                    conn.executemany(SQL_SET_MEDIA, args)
+                elif kind == "media_drop":
+                    conn.executemany(SQL_DROP_MEDIA, args)
+                elif kind == "state":
+                    conn.executemany(SQL_LOG_STATE, args)
+                elif kind == "state_drop":
+                    conn.executemany(SQL_DROP_STATE, args)
+                elif kind == "state_compact":
+                    conn.execute(SQL_COMPACT_STATE)
+                i = j
+
+def _resolve(fut: "asyncio.Future"):
+    if not fut.done():
+        fut.set_result(None)